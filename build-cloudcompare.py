@@ -1,116 +1,459 @@
 #!/usr/bin/env python3
 
 import argparse
+import json
+from concurrent.futures import ThreadPoolExecutor
 import multiprocessing
 import shutil
 from pathlib import Path
-from typing import Dict
+from typing import Callable, Dict, List, Optional, Tuple
 import subprocess
 import os
 import re
+import sys
+
+from macho import read_load_commands
 
 CMAKE = "cmake"
+NINJA = shutil.which("ninja") or "ninja"
+# Multi-config, so that the same build dir can be used
+# for every configuration without reconfiguring
+CMAKE_GENERATOR = "Ninja Multi-Config"
+CMAKE_CONFIGURATION_TYPES = ["Release", "RelWithDebInfo"]
+# Needed by the Ninja Multi-Config generator
+MIN_CMAKE_VERSION = (3, 17)
+MIN_NINJA_VERSION = (1, 10)
+# Number of source files merged in the same translation unit, when doing unity builds
+UNITY_BUILD_BATCH_SIZE = 16
+# Arch of the dependencies built with build-dependencies.py --universal
+UNIVERSAL_ARCH = "universal"
+UNIVERSAL_ARCHS = ["arm64", "x86_64"]
+
+# CMake options that do not depend on the arch, paths, or command line arguments
+_STATIC_CMAKE_FLAGS = (
+    "-DCMAKE_IGNORE_PATH=/opt/homebrew/lib/",
+    f"-DCMAKE_CONFIGURATION_TYPES={';'.join(CMAKE_CONFIGURATION_TYPES)}",
+    "-DCMAKE_JOB_POOL_LINK=link",
+    # CloudCompare CMake options
+    '-DOPTION_BUILD_CCVIEWER=OFF',
+    "-DCCCORELIB_USE_CGAL=ON",
+    "-DOPTION_USE_DXF_LIB=ON",
+    "-DOPTION_USE_SHAPE_LIB=ON",
+    "-DOPTION_USE_GDAL=ON",
+    # GL Plugins
+    "-DPLUGIN_GL_QEDL=ON",
+    "-DPLUGIN_GL_QSSAO=ON",
+    # Standard Plugins
+    "-DPLUGIN_STANDARD_QANIMATION=ON",
+    "-DPLUGIN_STANDARD_QBROOM=ON",
+    '-DPLUGIN_STANDARD_QCANUPO=ON',
+    '-DPLUGIN_STANDARD_QCOLORIMETRIC_SEGMENTER=ON',
+    '-DPLUGIN_STANDARD_QCOMPASS=ON',
+    '-DPLUGIN_STANDARD_QCSF=ON',
+    '-DPLUGIN_STANDARD_QFACETS=ON',
+    '-DPLUGIN_STANDARD_QHOUGH_NORMALS=ON',
+    "-DPLUGIN_STANDARD_QHPR=ON",
+    "-DPLUGIN_STANDARD_QM3C2=ON",
+    "-DPLUGIN_STANDARD_QMPLANE=ON",
+    "-DPLUGIN_STANDARD_QPCL=ON",
+    "-DPLUGIN_STANDARD_QPCV=ON",
+    "-DPLUGIN_STANDARD_QPOISSON_RECON=ON",
+    "-DPLUGIN_STANDARD_QRANSAC_SD=ON",
+    "-DPLUGIN_STANDARD_QSRA=ON",
+    "-DPLUGIN_STANDARD_MASONRY_QAUTO_SEG=OFF",  # TODO (not as important)
+    "-DPLUGIN_STANDARD_MASONRY_QMANUAL_SEG=OFF",  # TODO (not as important)
+    "-DPLUGIN_STANDARD_QCLOUDLAYERS=ON",
+    # IO Plugins
+    "-DPLUGIN_IO_QCORE=ON",
+    "-DPLUGIN_IO_QADDITIONAL=ON",
+    "-DPLUGIN_IO_QCSV_MATRIX=ON",
+    "-DPLUGIN_IO_QE57=ON",
+    "-DPLUGIN_IO_QPDAL=ON",
+    "-DPLUGIN_IO_QPHOTOSCAN=ON",
+)
 
 SCRIPT_DIR = Path(__file__).parent.absolute()
 
+# When its output is not a terminal, ninja prints the description
+# of an edge once it finished, e.g.:
+# [12/345] Linking CXX shared module plugins/core/Standard/qPCL/libQPCL_PLUGIN.dylib
+_NINJA_LINK_RE = re.compile(rb'^\[\d+/\d+\] Linking \w+ shared (?:module|library) (\S+)')
+
+# Max size of the chunks read from the build output
+OUTPUT_BUFFER_SIZE = 1024 * 1024
+
+# Matches the `project( CloudCompare VERSION x.y.z )` statement of qCC/CMakeLists.txt
+_VERSION_RE = re.compile(r'project\s*\(\s*\w+\s+VERSION\s+(\d[\d.]*)', re.IGNORECASE)
+
+
+def read_cloudcompare_version(source_dir: Path) -> str:
+    # The project statement is at the very top of the file
+    with open(source_dir / 'qCC' / 'CMakeLists.txt') as f:
+        head = f.read(512)
+
+    match = _VERSION_RE.search(head)
+    if match is None:
+        raise SystemExit(f"Could not find CloudCompare's version in {source_dir / 'qCC' / 'CMakeLists.txt'}")
+    return match.group(1)
+
+
+def parse_cmake_define(define: str) -> Tuple[str, str]:
+    """Splits a `-DNAME=VALUE` command line argument into (NAME, VALUE)"""
+    assert define.startswith("-D"), f"{define} is not a cache entry definition"
+    name, value = define[2:].split("=", 1)
+    return name, value
+
+
+def cmake_define_to_cache_entry(define: str) -> str:
+    """Converts a `-DNAME=VALUE` command line argument to the equivalent
+    `set` command of a CMake initial cache script (cmake -C)
+    """
+    name, value = parse_cmake_define(define)
+    value = value.replace("\\", "\\\\").replace('"', '\\"')
+    # FORCE is needed, otherwise values from an existing CMakeCache.txt
+    # would take precedence on reconfigure
+    return f'set({name} "{value}" CACHE STRING "" FORCE)'
+
+
+def print_build_args_changes(previous: Dict[str, str], current: Dict[str, str]) -> None:
+    """Prints what changed since the last configure, to explain why it is re-run"""
+    for name in sorted(current.keys() - previous.keys()):
+        print(f"Build arg added: {name}={current[name]}")
+    for name in sorted(previous.keys() - current.keys()):
+        print(f"Build arg removed: {name}={previous[name]}")
+    for name in sorted(previous.keys() & current.keys()):
+        if previous[name] != current[name]:
+            print(f"Build arg changed: {name}: {previous[name]} -> {current[name]}")
+
+
+def run_with_buffered_output(
+        command: List[str],
+        env: Dict[str, str],
+        on_line: Optional[Callable[[bytes], None]] = None,
+) -> None:
+    """Runs the command, forwarding its output in large chunks
+
+    Build tools print a line per compiled file, letting them write directly
+    to the terminal means a write syscall per line. Instead, everything
+    available in the pipe is read at once and shown as soon as the pipe is
+    drained, so output never stays buffered while the build is silent.
+
+    If given, `on_line` is called with each line of output as soon as it is read.
+    """
+    with subprocess.Popen(
+            command,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            bufsize=0,
+            env=env
+    ) as process:
+        fd = process.stdout.fileno()
+        partial_line = b''
+        while chunk := os.read(fd, OUTPUT_BUFFER_SIZE):
+            sys.stdout.buffer.write(chunk)
+            if len(chunk) < OUTPUT_BUFFER_SIZE:
+                # Nothing more pending, shown before blocking on the next read
+                sys.stdout.buffer.flush()
+            if on_line is not None:
+                *lines, partial_line = (partial_line + chunk).split(b'\n')
+                for line in lines:
+                    on_line(line + b'\n')
+        if on_line is not None and partial_line:
+            on_line(partial_line)
+        sys.stdout.buffer.flush()
+
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command)
+
+
+def default_num_jobs() -> int:
+    """Number of performance cores (+2 to hide I/O stalls) on Apple Silicon,
+    number of logical CPUs elsewhere.
+
+    Compiling on efficiency cores slows down the whole build
+    """
+    try:
+        num_perf_cores = int(subprocess.run(
+            ['sysctl', '-n', 'hw.perflevel0.physicalcpu'],
+            capture_output=True,
+            check=True
+        ).stdout)
+    except (OSError, ValueError, subprocess.CalledProcessError):
+        return multiprocessing.cpu_count()
+    return num_perf_cores + 2
+
+
+def default_num_link_jobs() -> int:
+    """Number of link jobs that can run concurrently without the machine swapping
+
+    Linking CloudCompare and its plugins can take 1-2 GB of memory per job,
+    one link job per 4 GB of RAM leaves room for the compile jobs
+    """
+    try:
+        mem_size = int(subprocess.run(
+            ['sysctl', '-n', 'hw.memsize'],
+            capture_output=True,
+            check=True
+        ).stdout)
+    except (OSError, ValueError, subprocess.CalledProcessError):
+        return 2
+    return max(1, mem_size // (4 * 1024 ** 3))
+
+
+def tool_version(command: List[str]) -> Tuple[int, int]:
+    """Returns the (major, minor) version of the tool as printed by the given command"""
+    version_output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+    match = re.search(r'(\d+)\.(\d+)', version_output)
+    if match is None:
+        raise SystemExit(f"Could not parse the version from the output of '{' '.join(command)}': {version_output}")
+    return int(match.group(1)), int(match.group(2))
+
+
+def format_version(version: Tuple[int, int]) -> str:
+    return ".".join(str(v) for v in version)
+
+
+def find_compiler_launcher() -> Optional[str]:
+    """Returns the path to the compiler cache to use as compiler launcher
+
+    sccache is preferred when a shared storage is configured for it
+    (SCCACHE_BUCKET or SCCACHE_REDIS env var), so that a CI runner benefits
+    from what the others already compiled, otherwise ccache is used.
+    """
+    if "SCCACHE_BUCKET" in os.environ or "SCCACHE_REDIS" in os.environ:
+        sccache_path = shutil.which("sccache")
+        if sccache_path is not None:
+            return sccache_path
+    return shutil.which("ccache")
+
 
 def run_build(args):
+    # Check versions upfront, some optimizations would otherwise be silently ignored
+    cmake_version = tool_version([CMAKE, "--version"])
+    if cmake_version < MIN_CMAKE_VERSION:
+        raise SystemExit(f"CMake >= {format_version(MIN_CMAKE_VERSION)} is required "
+                         f"(found {format_version(cmake_version)})")
+    ninja_version = tool_version([NINJA, "--version"])
+    if ninja_version < MIN_NINJA_VERSION:
+        raise SystemExit(f"Ninja >= {format_version(MIN_NINJA_VERSION)} is required "
+                         f"(found {format_version(ninja_version)})")
+
     workdir_path = SCRIPT_DIR / "workdir"
     dependencies_dir = workdir_path / args.arch / "install"
 
-    source_dir = args.cloudcompare_sources
+    source_dir = str(Path(args.cloudcompare_sources).absolute())
 
-    with open(f"{source_dir}/qCC/CMakeLists.txt") as f:
-        first_line = f.readline()
-        version_string = first_line.split()[3]
-        assert version_string[0] == '2'
+    version_string = read_cloudcompare_version(Path(source_dir))
+    assert version_string[0] == '2'
 
     build_dir = workdir_path / f"{args.arch}" / "builds" / f"CloudCompare-{version_string}"
     install_dir = workdir_path / f"{args.arch}" / f"CloudCompare-{version_string}"
 
-    EIGEN_ROOT_DIR = str(dependencies_dir / 'include' / 'eigen3')
+    deps_lib = dependencies_dir / 'lib'
+    deps_cmake = deps_lib / 'cmake'
+    deps_include = dependencies_dir / 'include'
+    app_plugins = install_dir / 'CloudCompare' / 'CloudCompare.app' / 'Contents' / 'Plugins' / 'ccPlugins'
+    flann_name = 'libflann_cpp.1.9.dylib'
+    flann_abs = str(deps_lib / flann_name)
+
+    # Strip absolute paths from the objects (C and C++), so that they do not
+    # depend on where the sources and build dir are located
+    file_prefix_map_flags = f"-ffile-prefix-map={source_dir}=. -ffile-prefix-map={build_dir}=."
+
+    EIGEN_ROOT_DIR = str(deps_include / 'eigen3')
+
+    osx_architectures = ";".join(UNIVERSAL_ARCHS) if args.arch == UNIVERSAL_ARCH else args.arch
+
+    env = os.environ.copy()
+    # So that nested builds (e.g. ExternalProject) also use the requested parallelism
+    env["CMAKE_BUILD_PARALLEL_LEVEL"] = str(args.num_jobs)
+    launcher_path = find_compiler_launcher() if args.use_ccache else None
+    # Always given, empty when no launcher is wanted, otherwise a build dir
+    # configured before with a launcher would keep using it
+    compiler_launcher_args = [
+        f"-DCMAKE_C_COMPILER_LAUNCHER={launcher_path or ''}",
+        f"-DCMAKE_CXX_COMPILER_LAUNCHER={launcher_path or ''}",
+    ]
+
+    if launcher_path is not None and Path(launcher_path).name == "ccache":
+        # So that cache entries can be shared between the different
+        # workdir/arch trees
+        env["CCACHE_BASEDIR"] = str(SCRIPT_DIR)
+        # Headers are regenerated by the configure step, so their
+        # timestamps must not prevent cache hits
+        env["CCACHE_SLOPPINESS"] = "pch_defines,time_macros,file_macro,include_file_mtime,include_file_ctime"
+        # One cache per arch, so that builds of one arch do not evict the other's entries
+        # (values already set in the environment take precedence)
+        env.setdefault("CCACHE_DIR", str(workdir_path / args.arch / ".ccache"))
+        env.setdefault("CCACHE_MAXSIZE", "10G")
+        # Hash the compiler itself rather than its mtime, so that compiler upgrades invalidate the cache
+        env.setdefault("CCACHE_COMPILERCHECK", "content")
+
+    cmake_args = [
+        *compiler_launcher_args,
+        f"-DCMAKE_FIND_ROOT_PATH={dependencies_dir}",
+        f"-DCMAKE_PREFIX_PATH={deps_cmake}",
+        f"-DCMAKE_INCLUDE_PATH={deps_include}",
+        f"-DCMAKE_INSTALL_PREFIX={install_dir}",
+        # '-DCMAKE_MACOSX_RPATH=OFF',
+        # macOS special things
+        f"-DCMAKE_OSX_ARCHITECTURES={osx_architectures}",
+        f"-DCMAKE_OSX_DEPLOYMENT_TARGET={args.macos_version}",
+        # CloudCompare triggers a bunch of deprecated when built with Qt5.15
+        # Others ignored warnings are from RANSAC
+        "-DCMAKE_CXX_FLAGS=-Wno-deprecated -Wno-writable-strings -Wno-inconsistent-missing-override -DDLIB_NO_GUI_SUPPORT -DCC_MAC_DEV_PATHS"
+        f" {file_prefix_map_flags}",
+        f"-DCMAKE_C_FLAGS={file_prefix_map_flags}",
+        f"-DCMAKE_INSTALL_RPATH={deps_lib}",
+        f"-DEIGEN_ROOT_DIR={EIGEN_ROOT_DIR}",
+        # Compile jobs are already limited by ninja's -j
+        f"-DCMAKE_JOB_POOLS=link={args.num_link_jobs}",
+        *_STATIC_CMAKE_FLAGS,
+    ]
+
+    # Lets tools like clangd reuse the compilation database instead of reconfiguring
+    # (multi-config generators support it since 3.20)
+    export_compile_commands = cmake_version >= (3, 20)
+    if export_compile_commands:
+        cmake_args.append("-DCMAKE_EXPORT_COMPILE_COMMANDS=ON")
+    else:
+        print(f"CMake {format_version(cmake_version)} cannot export compile commands "
+              f"with the '{CMAKE_GENERATOR}' generator, CMake >= 3.20 is needed")
+
+    if args.unity_build:
+        # Merges sources files, so that heavy headers (CGAL, Eigen, Qt)
+        # are parsed once per batch instead of once per file
+        cmake_args.extend([
+            "-DCMAKE_UNITY_BUILD=ON",
+            f"-DCMAKE_UNITY_BUILD_BATCH_SIZE={UNITY_BUILD_BATCH_SIZE}",
+        ])
+        if cmake_version >= (3, 19):
+            cmake_args.append("-DCMAKE_PCH_INSTANTIATE_TEMPLATES=ON")
+        unset_cache_entries = []
+    else:
+        # Explicitly turned off, and the unity entries dropped from the cache,
+        # otherwise a build dir configured with --unity would stay a unity build
+        cmake_args.append("-DCMAKE_UNITY_BUILD=OFF")
+        unset_cache_entries = ["CMAKE_UNITY_BUILD_BATCH_SIZE", "CMAKE_PCH_INSTANTIATE_TEMPLATES"]
 
     build_dir.mkdir(exist_ok=True)
-    subprocess.run(
-        [
-            CMAKE,
-            "-S", source_dir,
-            "-B", build_dir,
-            "-GNinja",
-            f"-DCMAKE_FIND_ROOT_PATH={dependencies_dir}",
-            f"-DCMAKE_PREFIX_PATH={dependencies_dir / 'lib' / 'cmake'}",
-            f"-DCMAKE_INCLUDE_PATH={dependencies_dir / 'include'}",
-            "-DCMAKE_IGNORE_PATH=/opt/homebrew/lib/",
-            "-DCMAKE_BUILD_TYPE=Release",
-            f"-DCMAKE_INSTALL_PREFIX={install_dir}",
-            # '-DCMAKE_MACOSX_RPATH=OFF',
-            # macOS special things
-            f"-DCMAKE_OSX_ARCHITECTURES={args.arch}",
-            f"-DCMAKE_OSX_DEPLOYMENT_TARGET={args.macos_version}",
-            # CloudCompare triggers a bunch of deprecated when built with Qt5.15
-            # Others ignored warnings are from RANSAC
-            "-DCMAKE_CXX_FLAGS=-Wno-deprecated -Wno-writable-strings -Wno-inconsistent-missing-override -DDLIB_NO_GUI_SUPPORT -DCC_MAC_DEV_PATHS",
-            f"-DCMAKE_INSTALL_RPATH={dependencies_dir / 'lib'}",
-            f"-DEIGEN_ROOT_DIR={EIGEN_ROOT_DIR}",
-            # CloudCompare CMake options
-            '-DOPTION_BUILD_CCVIEWER=OFF',
-            f"-DCCCORELIB_USE_CGAL=ON",
-            "-DOPTION_USE_DXF_LIB=ON",
-            "-DOPTION_USE_SHAPE_LIB=ON",
-            "-DOPTION_USE_GDAL=ON",
-            # GL Plugins
-            "-DPLUGIN_GL_QEDL=ON",
-            "-DPLUGIN_GL_QSSAO=ON",
-            # Standard Plugins
-            "-DPLUGIN_STANDARD_QANIMATION=ON",
-            "-DPLUGIN_STANDARD_QBROOM=ON",
-            '-DPLUGIN_STANDARD_QCANUPO=ON',
-            '-DPLUGIN_STANDARD_QCOLORIMETRIC_SEGMENTER=ON',
-            '-DPLUGIN_STANDARD_QCOMPASS=ON',
-            '-DPLUGIN_STANDARD_QCSF=ON',
-            '-DPLUGIN_STANDARD_QFACETS=ON',
-            '-DPLUGIN_STANDARD_QHOUGH_NORMALS=ON',
-            "-DPLUGIN_STANDARD_QHPR=ON",
-            "-DPLUGIN_STANDARD_QM3C2=ON",
-            "-DPLUGIN_STANDARD_QMPLANE=ON",
-            "-DPLUGIN_STANDARD_QPCL=ON",
-            "-DPLUGIN_STANDARD_QPCV=ON",
-            "-DPLUGIN_STANDARD_QPOISSON_RECON=ON",
-            "-DPLUGIN_STANDARD_QRANSAC_SD=ON",
-            "-DPLUGIN_STANDARD_QSRA=ON",
-            "-DPLUGIN_STANDARD_MASONRY_QAUTO_SEG=OFF",  # TODO (not as important)
-            "-DPLUGIN_STANDARD_MASONRY_QMANUAL_SEG=OFF",  # TODO (not as important)
-            "-DPLUGIN_STANDARD_QCLOUDLAYERS=ON",
-            # IO Plugins
-            "-DPLUGIN_IO_QCORE=ON",
-            "-DPLUGIN_IO_QADDITIONAL=ON",
-            "-DPLUGIN_IO_QCSV_MATRIX=ON",
-            "-DPLUGIN_IO_QE57=ON",
-            "-DPLUGIN_IO_QPDAL=ON",
-            "-DPLUGIN_IO_QPHOTOSCAN=ON",
-        ],
-        check=True,
-    )
-
-    subprocess.run([CMAKE, "--build", str(build_dir), f"-j{args.num_jobs}"], check=True)
-    subprocess.run([CMAKE, "--install", str(build_dir)], check=True)
-
-    subprocess.run([
-        'install_name_tool',
-        '-change',
-        'libflann_cpp.1.9.dylib',
-        str(dependencies_dir /'lib' / "libflann_cpp.1.9.dylib"),
-        str(install_dir / 'CloudCompare' / 'CloudCompare.app' / 'Contents' / 'Plugins' / 'ccPlugins' / 'libQPCL_IO_PLUGIN.dylib')
-    ])
-    
-    subprocess.run([
-        'install_name_tool',
-        '-change',
-        'libflann_cpp.1.9.dylib',
-        str(dependencies_dir /'lib' / "libflann_cpp.1.9.dylib"),
-        str(install_dir / 'CloudCompare' / 'CloudCompare.app' / 'Contents' / 'Plugins' / 'ccPlugins' / 'libQPCL_PLUGIN.dylib')
-    ])
 
+    # The options are given to CMake through an initial cache script,
+    # so that the command line stays small and stable between runs
+    cache_init_content = "\n".join([
+        *(cmake_define_to_cache_entry(arg) for arg in cmake_args),
+        *(f"unset({name} CACHE)" for name in unset_cache_entries),
+    ]) + "\n"
+    cache_init_path = build_dir / "cache-init.cmake"
+    if not cache_init_path.exists() or cache_init_path.read_text() != cache_init_content:
+        cache_init_path.write_text(cache_init_content)
+
+    # Re-running the configure step is costly, so only do it
+    # when the arguments changed since the last successful configure
+    build_args = {"generator": CMAKE_GENERATOR, **dict(parse_cmake_define(arg) for arg in cmake_args)}
+    build_args_path = build_dir / ".build-args.json"
+    previous_build_args = json.loads(build_args_path.read_text()) if build_args_path.exists() else None
+    is_configured = (build_dir / "CMakeCache.txt").exists() and previous_build_args == build_args
+    if previous_build_args is not None and previous_build_args != build_args:
+        print_build_args_changes(previous_build_args, build_args)
+
+    if is_configured and not args.force_reconfigure:
+        print("CMake arguments did not change, skipping the configure step")
+    else:
+        subprocess.run(
+            [CMAKE, "-S", source_dir, "-B", build_dir, f"-G{CMAKE_GENERATOR}", "-C", str(cache_init_path)],
+            check=True,
+            env=env
+        )
+        build_args_path.write_text(json.dumps(build_args, sort_keys=True, indent=2))
+
+    if export_compile_commands:
+        compile_commands_link = Path(source_dir) / "compile_commands.json"
+        compile_commands_path = build_dir / "compile_commands.json"
+        # A link to the database of another build dir (e.g. other version or arch)
+        # is replaced, a regular file is left as is, it is not ours
+        if compile_commands_link.is_symlink() and Path(os.readlink(compile_commands_link)) != compile_commands_path:
+            compile_commands_link.unlink()
+        try:
+            compile_commands_link.symlink_to(compile_commands_path)
+        except FileExistsError:
+            pass
+
+    ninja_file = f"build-{args.config}.ninja"
+
+    # The install target always re-runs, so instead we look if the build
+    # has anything to do, if not, the previous install is still up to date
+    is_install_up_to_date = False
+    if args.incremental and install_dir.exists():
+        dry_run = subprocess.run(
+            [NINJA, "-C", str(build_dir), "-f", ninja_file, "-n"],
+            capture_output=True,
+            text=True,
+            env=env
+        )
+        is_install_up_to_date = dry_run.returncode == 0 and "no work to do" in dry_run.stdout
+
+    # Plugins that were linked against flann.
+    # flann is now built with an @rpath install name, which is resolved through
+    # CMAKE_INSTALL_RPATH, so this is only needed with dependencies built before
+    # that, where the install name is the bare lib name
+    patch_targets = [
+        app_plugins / 'libQPCL_IO_PLUGIN.dylib',
+        app_plugins / 'libQPCL_PLUGIN.dylib',
+    ]
+
+    def fix_flann_load_path(plugin_path: Path) -> None:
+        # On incremental builds, the plugin may already be patched,
+        # rewriting it anyway would needlessly invalidate its signature
+        if not plugin_path.exists():
+            return
+        loaded_libs, _ = read_load_commands(plugin_path)
+        if Path(flann_name) not in loaded_libs:
+            return
+
+        subprocess.run([
+            'install_name_tool',
+            '-change',
+            flann_name,
+            flann_abs,
+            str(plugin_path)
+        ], check=True)
+
+    patch_target_names = {target.name for target in patch_targets}
+
+    # Prevent the mac from going to sleep during the (long) build
+    caffeinate = shutil.which("caffeinate")
+    keep_awake_prefix = [caffeinate, "-i"] if caffeinate is not None else []
+    with ThreadPoolExecutor(max_workers=len(patch_targets)) as executor:
+        fixups = []
+
+        def on_build_output_line(line: bytes) -> None:
+            # Patch the plugins in the build tree as soon as they are linked,
+            # while ninja continues with the rest of the build
+            match = _NINJA_LINK_RE.match(line)
+            if match is not None:
+                output = build_dir / match.group(1).decode()
+                if output.name in patch_target_names:
+                    fixups.append(executor.submit(fix_flann_load_path, output))
+
+        run_with_buffered_output(
+            # Ninja is called directly, going through `cmake --build` only adds a process
+            [*keep_awake_prefix, NINJA, "-C", str(build_dir), "-f", ninja_file, f"-j{args.num_jobs}"],
+            env=env,
+            on_line=on_build_output_line,
+        )
+        for fixup in fixups:
+            fixup.result()
+
+    if is_install_up_to_date:
+        print("Nothing was rebuilt, skipping the install step")
+    else:
+        subprocess.run([CMAKE, "--install", str(build_dir), "--config", args.config], check=True, env=env)
+
+    # Installed plugins are normally already patched, but the build tree
+    # may come from a previous run that did not patch them
+    with ThreadPoolExecutor(max_workers=len(patch_targets)) as executor:
+        list(executor.map(fix_flann_load_path, patch_targets))
 
 
 def main():
@@ -118,10 +461,30 @@ def main():
                                                  "by the build-dependencies script")
 
     parser.add_argument("cloudcompare_sources", help="Path to the root folder with CloudCompare's sources")
-    parser.add_argument("arch", help="The arch for which cloud compare should be build")
+    parser.add_argument("arch", help="The arch for which cloud compare should be build, "
+                                     f"'{UNIVERSAL_ARCH}' for universal binaries ({', '.join(UNIVERSAL_ARCHS)}) "
+                                     "using the dependencies built with build-dependencies.py --universal")
     parser.add_argument("macos_version", help="The minimum macOS version targeted", metavar="macos-version")
-    parser.add_argument("--num-jobs", help="Number of jobs / threads for the build",
-                        default=multiprocessing.cpu_count())
+    parser.add_argument("--num-jobs", help="Number of jobs / threads for the build", type=int,
+                        default=default_num_jobs())
+    parser.add_argument("--num-link-jobs", help="Max number of link jobs running at the same time", type=int,
+                        default=default_num_link_jobs())
+    parser.add_argument("--config", help="The build configuration to build and install",
+                        choices=CMAKE_CONFIGURATION_TYPES, default="Release")
+    parser.add_argument("--no-ccache",
+                        help="Do not use a compiler cache as compiler launcher, even if one is available. "
+                             "ccache is used by default, sccache is used instead when its shared storage is "
+                             "configured, e.g. SCCACHE_BUCKET=my-bucket AWS_REGION=eu-west-3 "
+                             "or SCCACHE_REDIS=redis://host",
+                        action="store_false", dest="use_ccache")
+    parser.add_argument("--unity", help="Enable CMake's unity build", action="store_true",
+                        dest="unity_build", default=False)
+    parser.add_argument("--no-unity", help="Disable CMake's unity build (default)", action="store_false",
+                        dest="unity_build")
+    parser.add_argument("--incremental", help="Skip the install step if nothing was rebuilt since the last install",
+                        action="store_true")
+    parser.add_argument("--force-reconfigure", help="Run CMake's configure step even if the arguments did not change",
+                        action="store_true")
 
     args = parser.parse_args()
     run_build(args)
@@ -2,24 +2,29 @@
 
 from abc import ABC, abstractmethod
 from contextlib import contextmanager
-from typing import Dict, List, Optional, Union, Any, NoReturn
+from typing import Dict, List, Optional, Tuple, Union, Any, NoReturn
 import os
-from dataclasses import dataclass
+import functools
+from dataclasses import dataclass, field
 from pathlib import Path
 import sys
 import logging
 
 import subprocess
+import collections
 import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
 import platform
 import shutil
 from subprocess import CalledProcessError
 import re
+import tarfile
 import argparse
 import hashlib
+import json
+import filecmp
 
-# TODO: avoid redoing some steps like extraction, configuration, building if it was already done and
-#       shit did not change
+from macho import MACHO_MAGICS, read_load_commands
 
 # https://cmake.org/cmake/help/latest/manual/cmake-toolchains.7.html
 # https://stackoverflow.com/questions/24659753/cmake-find-library-and-cmake-find-root-path
@@ -29,20 +34,38 @@ import hashlib
 # https://clang.llvm.org/docs/CommandGuide/clang.html
 
 
+# Queried once, they do not change during the run
+SYSTEM = platform.system()
+HOST_MACHINE = platform.machine()
+
+# Name used in place of the arch for universal builds
+UNIVERSAL_ARCH = "universal"
+UNIVERSAL_ARCHS = ["arm64", "x86_64"]
+
+# Number of source files merged into one translation unit for unity builds
+UNITY_BUILD_BATCH_SIZE = 16
+
+
 class Config:
     def __init__(
         self,
         target_arch: Optional[str] = None,
         target_os_version: Optional[str] = None,
         num_jobs: Optional[int] = None,
+        max_parallel_dependencies: Optional[int] = None,
+        universal: bool = False,
+        build_config: str = "Release",
     ) -> None:
-        if target_arch is None:
-            target_arch = platform.machine()
+        if universal:
+            target_arch = UNIVERSAL_ARCH
+        elif target_arch is None:
+            target_arch = HOST_MACHINE
 
-        if target_os_version is not None and platform.system() != 'Darwin':
+        if target_os_version is not None and SYSTEM != 'Darwin':
             raise ValueError("target_os_version is only for macos")
-        elif target_os_version is None and platform.system() == 'Darwin':
-            if target_arch == 'x86_64':
+        elif target_os_version is None and SYSTEM == 'Darwin':
+            # For universal builds, clang raises the min version to 11.0 for the arm64 part
+            if target_arch in ('x86_64', UNIVERSAL_ARCH):
                 target_os_version = "10.15"
             elif target_arch == "arm64":
                 target_os_version = "11.0"
@@ -52,9 +75,22 @@ class Config:
         if num_jobs is None:
             num_jobs = multiprocessing.cpu_count()
 
+        if max_parallel_dependencies is None:
+            # Each dependency build gets num_jobs / max_parallel_dependencies jobs,
+            # keep enough jobs per dependency for the big ones (Qt, boost, PCL)
+            max_parallel_dependencies = max(1, min(4, num_jobs // 4))
+
         self.target_arch = target_arch
+        # The archs actually compiled for, universal builds of CMake, boost and Qt
+        # compile for both archs at once (each file is parsed once and compiled twice)
+        self.target_archs: List[str] = UNIVERSAL_ARCHS if universal else [target_arch]
+        self.universal = universal
         self.target_os_version = target_os_version
+        # Configuration (Release, Debug, ...) CMake dependencies are built in
+        self.build_config = build_config
         self.num_jobs = num_jobs
+        # Number of dependencies that can be built at the same time
+        self.max_parallel_dependencies = max_parallel_dependencies
 
         # Some important path which will be needed throughout:
         self.script_dir: Path = Path(__file__).parent
@@ -64,6 +100,8 @@ class Config:
         self.arch_dir: Path = self.working_dir / self.target_arch
         # Where build folder for each dependencies will be stored
         self.build_dir: Path = self.arch_dir / "builds"
+        # Where the output of the commands run for each dependency is written
+        self.logs_dir: Path = self.arch_dir / "logs"
 
         # Root path where depdencies built will be installed
         self.install_root: Path = self.arch_dir / "install"
@@ -72,22 +110,17 @@ class Config:
         self.install_include: Path = self.install_root / 'include'
         self.pkg_config_path: Path = self.install_lib / 'pkgconfig'
 
-        self.working_dir.mkdir(exist_ok=True, parents=True)
-        self.sources_dir.mkdir(exist_ok=True, parents=True)
-        self.arch_dir.mkdir(exist_ok=True, parents=True)
-        self.build_dir.mkdir(exist_ok=True, parents=True)
+        self._ensure_dirs()
 
         # The environment variables that should be set when running a command
-        self.env_vars: Dict[str, str] = {
-            **os.environ,
-            "PKG_CONFIG_PATH": str(self.pkg_config_path),
-        }
+        self.env_vars: Dict[str, str] = dict(os.environ)
+        self.env_vars['PKG_CONFIG_PATH'] = str(self.pkg_config_path)
         self.env_vars['PATH'] = f"{str(self.install_bin)}:{self.env_vars['PATH']}"
 
         # Dict with default config that should be used by the CMake build system
         self.cmake_default_config_opts = {
             "-G": "Ninja",
-            "-DCMAKE_BUILD_TYPE": "Release",
+            "-DCMAKE_BUILD_TYPE": self.build_config,
             "-DCMAKE_INSTALL_PREFIX": str(self.install_root),
             # Otherwise, on some Linux some lib would be in /lib and others in /lib64
             "-DCMAKE_INSTALL_LIBDIR": str(self.install_lib),
@@ -102,8 +135,21 @@ class Config:
             # "-DCMAKE_SKIP_RPATH": "TRUE",
         }
 
-        if platform.system() == "Darwin":
-            self.cmake_default_config_opts['-DCMAKE_OSX_ARCHITECTURES'] = self.target_arch
+        # Compiler variables given to autotools' configure
+        self.autotools_compiler_vars: List[str] = []
+
+        ccache_path = shutil.which("ccache")
+        if ccache_path is not None:
+            self.cmake_default_config_opts['-DCMAKE_C_COMPILER_LAUNCHER'] = ccache_path
+            self.cmake_default_config_opts['-DCMAKE_CXX_COMPILER_LAUNCHER'] = ccache_path
+            # Not put in env_vars, CMake would also pick them up
+            self.autotools_compiler_vars = [f"CC={ccache_path} cc", f"CXX={ccache_path} c++"]
+            # So that moving the workdir does not invalidate the cache
+            self.env_vars['CCACHE_BASEDIR'] = str(self.working_dir)
+            self.env_vars['CCACHE_SLOPPINESS'] = "time_macros,include_file_mtime"
+
+        if SYSTEM == "Darwin":
+            self.cmake_default_config_opts['-DCMAKE_OSX_ARCHITECTURES'] = ";".join(self.target_archs)
             self.cmake_default_config_opts['-DCMAKE_OSX_DEPLOYMENT_TARGET'] = self.target_os_version
 
         # List of default options for Autotools build system
@@ -121,13 +167,15 @@ class Config:
         # aka LDFLAGS
         self.linker_flags: str = f"-L{self.install_lib}"
 
-        if platform.system() == "Darwin":
+        if SYSTEM == "Darwin":
             assert self.target_os_version is not None, "Target OS Version not set"
             macos_version_flag = f" -mmacosx-version-min={self.target_os_version}"
             self.compiler_flags += macos_version_flag
             self.linker_flags += macos_version_flag
 
-            if self.target_arch != platform.machine():
+            # No -arch flags for universal builds, Autotools dependencies are built
+            # once per arch (see Autotools), boost adds the flags of all the archs itself
+            if not self.universal and self.target_arch != HOST_MACHINE:
                 # The 'target-triple' to cross compile with clang
                 target_triple = f"{self.target_arch}-apple-darwin"
                 self.compiler_flags += f' --target={target_triple}'
@@ -137,25 +185,44 @@ class Config:
                 self.linker_flags += f' -arch {self.target_arch}'
 
 
+    def _ensure_dirs(self) -> None:
+        # The logs dir is created last, if it exists, all the others do
+        if self.logs_dir.is_dir():
+            return
+        for path in (self.working_dir, self.sources_dir, self.arch_dir, self.build_dir, self.logs_dir):
+            path.mkdir(exist_ok=True, parents=True)
+
     @classmethod
     def from_cmdline(cls):
         parser = argparse.ArgumentParser(description="Downloads and builds the dependencies for CloudCompare on macOS")
 
-        parser.add_argument("arch", help="The arch for which cloud compare should be build")
+        parser.add_argument("arch", help="The arch for which cloud compare should be build (ignored with --universal)")
         parser.add_argument("macos_version", help="The minimum macOS version targeted", metavar="macos-version")
-        parser.add_argument("--num-jobs", help="Number of jobs / threads for the build", default=None)
+        parser.add_argument("--num-jobs", help="Number of jobs / threads for the build", type=int, default=None)
+        parser.add_argument("--universal", help=f"Build universal binaries ({', '.join(UNIVERSAL_ARCHS)}) "
+                                                f"instead of building for a single arch, "
+                                                f"they are installed in workdir/{UNIVERSAL_ARCH}",
+                            action="store_true")
+        parser.add_argument("--max-parallel-dependencies", help="Number of dependencies built at the same time, "
+                                                                "the jobs are split between them",
+                            type=int, default=None)
+        parser.add_argument("--config", help="Configuration the CMake dependencies are built in, "
+                                             "with CMake >= 3.17 all configurations share the same build tree",
+                            choices=["Release", "Debug", "RelWithDebInfo"], default="Release")
 
         args = parser.parse_args()
 
         return cls(
             target_arch=args.arch,
             target_os_version=args.macos_version,
-            num_jobs=args.num_jobs
+            num_jobs=args.num_jobs,
+            max_parallel_dependencies=args.max_parallel_dependencies,
+            universal=args.universal,
+            build_config=args.config,
         )
 
 
 CONFIG: Config = Config.from_cmdline()
-CONFIG.working_dir.mkdir(exist_ok=True)
 
 # Commands
 CMAKE = "cmake"
@@ -163,25 +230,74 @@ CURL = "curl"
 MAKE = "make"
 GIT = 'git'
 
+# First CMake version with the Ninja Multi-Config generator
+MIN_CMAKE_MULTI_CONFIG_VERSION = (3, 17)
+
+# First CMake version where `cmake --install` accepts --parallel
+MIN_CMAKE_PARALLEL_INSTALL_VERSION = (3, 31)
+
 CAPTURE=False
 
+# Number of last output lines of a command kept to be logged if it fails
+OUTPUT_TAIL_SIZE = 500
+
+# Log file the output of the commands is appended to, set for each dependency handled
+CURRENT_LOG_PATH: Optional[Path] = None
+
 LOGGER = logging.getLogger(__name__)
 
 
-def run_command(*args, **kwargs):
-    if CAPTURE:
-        stdout, stderr = subprocess.PIPE, subprocess.STDOUT
-    else:
-        stdout, stderr = sys.stdout, sys.stderr
+def run_command(command, **kwargs):
+    """Runs the command, streaming its output line by line
 
-    LOGGER.debug(f"Running Command {args[0]}")
-    # print(" ".join(str(args[0])))
-    subprocess.run(*args, **kwargs, check=True, stdout=stdout, stderr=stderr, env=CONFIG.env_vars)
+    The output goes to the log file of the current dependency (if any),
+    and to stdout unless CAPTURE is set. Only the last lines are kept
+    in memory, they are the output of the CalledProcessError raised on failure.
+    """
+    LOGGER.debug(f"Running Command {command}")
+    tail = collections.deque(maxlen=OUTPUT_TAIL_SIZE)
+    log_file = open(CURRENT_LOG_PATH, 'a') if CURRENT_LOG_PATH is not None else None
+    try:
+        if log_file is not None:
+            log_file.write(f"$ {' '.join(str(arg) for arg in command)}\n")
+        with subprocess.Popen(
+            command,
+            **kwargs,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            bufsize=1,
+            text=True,
+            errors='replace',
+            env=CONFIG.env_vars,
+        ) as process:
+            for line in process.stdout:
+                tail.append(line)
+                if log_file is not None:
+                    log_file.write(line)
+                if not CAPTURE:
+                    sys.stdout.write(line)
+    finally:
+        if log_file is not None:
+            log_file.close()
+
+    if process.returncode != 0:
+        raise CalledProcessError(process.returncode, command, output=''.join(tail))
+
+
+@functools.lru_cache(maxsize=None)
+def cmake_version() -> Tuple[int, ...]:
+    output = subprocess.run([CMAKE, '--version'], check=True, capture_output=True, text=True).stdout
+    match = re.search(r"(\d+)\.(\d+)", output)
+    if match is None:
+        return (0, 0)
+    return tuple(int(part) for part in match.groups())
 
 
 def maybe_log_subprocess_error(exc: subprocess.CalledProcessError) -> NoReturn:
-    if CAPTURE:
-        logging.critical(exc.stdout.decode())
+    if CAPTURE and exc.stdout:
+        logging.critical(exc.stdout)
+    if CURRENT_LOG_PATH is not None:
+        logging.critical(f"Full output is in {CURRENT_LOG_PATH}")
     exit(1)
 
 
@@ -224,61 +340,202 @@ class SourceDistribution(ABC):
         ...
 
     @abstractmethod
-    def verify_checksum(self):
+    def verify_checksum(self, path: str) -> None:
         ...
 
 
+# Number of consecutive entries under already known top level entries
+# after which the listing of an archive is stopped
+TAR_LISTING_STOP_THRESHOLD = 1000
+
+# Entries at the top level of an archive, the listing is not decoded
+_TOP_LEVEL_RE = re.compile(rb"^[^/]+/?$")
+
+
 def parse_top_level_dir_of_tar(archive_path: str) -> str:
-    pc = subprocess.run(["tar", "-tf", archive_path], check=True, stdout=subprocess.PIPE)
-    lines = pc.stdout.decode().splitlines()
-    regex = re.compile("^[^/]+/?$")
-    matches = []
-    for line in lines:
-        if regex.match(line) is not None:
-            matches.append(line)
+    # Archives have a single top level dir, so instead of listing the whole
+    # archive (boost has 70k+ entries), stop once no new top level entry
+    # appeared for a while
+    matches = set()
+    top_levels = set()
+    num_lines_without_new_top_level = 0
+
+    with subprocess.Popen(["tar", "-tf", archive_path], stdout=subprocess.PIPE) as pc:
+        for line in pc.stdout:
+            line = line.rstrip(b"\n")
+            if _TOP_LEVEL_RE.match(line) is not None:
+                matches.add(line)
+
+            top_level = line.split(b"/", 1)[0]
+            if top_level in top_levels:
+                num_lines_without_new_top_level += 1
+                if num_lines_without_new_top_level >= TAR_LISTING_STOP_THRESHOLD:
+                    pc.terminate()
+                    break
+            else:
+                top_levels.add(top_level)
+                num_lines_without_new_top_level = 0
+        else:
+            if pc.wait() != 0:
+                raise CalledProcessError(pc.returncode, pc.args)
 
     # The above may not be correct for some tarballs
     # try something else
     if len(matches) != 1:
-        top_levels = set()
-        for line in lines:
-            top_levels.add(Path(line).parts[0])
-
         assert len(top_levels) == 1
-        matches = list(top_levels)
+        matches = top_levels
 
     assert len(matches) == 1
-    return matches[0]
+    return next(iter(matches)).decode()
 
 
 def extract_archive(archive_path: str, dest_folder):
+    # Single streaming pass that extracts and collects the top level entries,
+    # instead of running tar to extract and again to list
+    try:
+        top_levels = set()
+        with tarfile.open(archive_path, 'r|*') as tf:
+            # Same behaviour as the tar command, sources are trusted
+            tf.extraction_filter = getattr(tarfile, 'fully_trusted_filter', None)
+            for member in tf:
+                top_levels.add(member.name.split('/', 1)[0])
+                tf.extract(member, dest_folder)
+    except (tarfile.ReadError, tarfile.CompressionError) as e:
+        LOGGER.debug(f"tarfile could not extract {archive_path} ({e}), using tar")
+        return extract_archive_with_tar(archive_path, dest_folder)
+
+    assert len(top_levels) == 1, f"Expected a single top level dir in {archive_path}, got {top_levels}"
+    return str(Path(dest_folder) / top_levels.pop())
+
+
+def extract_archive_with_tar(archive_path: str, dest_folder):
 
     if archive_path.endswith(".tar.gz"):
-        subprocess.run(['tar', '-xzf', archive_path, '-C', dest_folder])
+        subprocess.run(['tar', '-xzf', archive_path, '-C', dest_folder], check=True)
         extract_dir_name = parse_top_level_dir_of_tar(archive_path)
         return str(Path(dest_folder) / extract_dir_name)
 
     if archive_path.endswith(".tar.xz"):
-        subprocess.run(['tar', '-xf', archive_path, '-C', dest_folder])
+        subprocess.run(['tar', '-xf', archive_path, '-C', dest_folder], check=True)
         extract_dir_name = parse_top_level_dir_of_tar(archive_path)
         return str(Path(dest_folder) / extract_dir_name)
 
     if archive_path.endswith(".tar.bz2"):
-        subprocess.run(['tar', '-xjf', archive_path, '-C', dest_folder])
+        subprocess.run(['tar', '-xjf', archive_path, '-C', dest_folder], check=True)
         extract_dir_name = parse_top_level_dir_of_tar(archive_path)
         return str(Path(dest_folder) / extract_dir_name)
 
     raise NotImplementedError
 
 
+# tar option to decompress the archive, needed when reading from a pipe
+TAR_DECOMPRESSION_OPTIONS = {
+    ".tar.gz": "-z",
+    ".tar.xz": "-J",
+    ".tar.bz2": "-j",
+}
+
+# Size of the chunks read from the downloading process
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def download_and_extract_archive(url: str, archive_path: str, dest_folder: str, hasher=None) -> str:
+    """Downloads the archive to `archive_path` while extracting it into `dest_folder`
+
+    The downloaded bytes are written to the archive file and piped into tar
+    at the same time, so that the archive is not read back from the disk.
+    If given, the `hasher` (a hashlib object) is updated with the downloaded bytes.
+    """
+    for extension, decompression_option in TAR_DECOMPRESSION_OPTIONS.items():
+        if archive_path.endswith(extension):
+            break
+    else:
+        raise NotImplementedError
+
+    partial_archive_path = f"{archive_path}.part"
+    entries_before = set(os.listdir(dest_folder))
+
+    curl_command = [CURL, '--location', '--fail', '--silent', '--show-error', url]
+    tar_command = ['tar', '-x', decompression_option, '-f', '-', '-C', dest_folder]
+    LOGGER.debug(f"Running Command {curl_command} | {tar_command}")
+    curl = subprocess.Popen(curl_command, stdout=subprocess.PIPE, env=CONFIG.env_vars)
+    tar = subprocess.Popen(tar_command, stdin=subprocess.PIPE, env=CONFIG.env_vars)
+    try:
+        with open(partial_archive_path, 'wb') as archive_file:
+            while chunk := curl.stdout.read(DOWNLOAD_CHUNK_SIZE):
+                archive_file.write(chunk)
+                if hasher is not None:
+                    hasher.update(chunk)
+                tar.stdin.write(chunk)
+    except BrokenPipeError:
+        # tar stopped early, its return code tells why
+        curl.kill()
+    finally:
+        curl.stdout.close()
+        try:
+            tar.stdin.close()
+        except BrokenPipeError:
+            pass
+
+    # tar first: when it fails, curl is killed (or gets a broken pipe),
+    # and curl's return code would hide the actual error
+    for process, command in ((tar, tar_command), (curl, curl_command)):
+        if process.wait() != 0:
+            raise CalledProcessError(process.returncode, command)
+
+    # Only now the archive is complete, a partial archive must not be mistaken for a downloaded one
+    os.replace(partial_archive_path, archive_path)
+
+    new_entries = set(os.listdir(dest_folder)) - entries_before - {Path(archive_path).name, Path(partial_archive_path).name}
+    if len(new_entries) == 1:
+        extract_dir_name = new_entries.pop()
+    else:
+        # Sources were extracted over an existing dir
+        extract_dir_name = parse_top_level_dir_of_tar(archive_path)
+    return str(Path(dest_folder) / extract_dir_name)
+
+
 @dataclass
 class Dependency:
     name: str
     # version: str
     source: SourceDistribution
     build_system: BuildSystem
+    # Names of the dependencies that must be installed before this one is built
+    deps_on: List[str] = field(default_factory=list)
+
+    def fingerprint(self) -> str:
+        """Hash of everything that affects the result of building this dependency,
+        including the fingerprints of the dependencies it depends on
+        """
+        dependencies_by_name = {dependency.name: dependency for dependency in DEPENDENCIES}
+        inputs = {
+            "name": self.name,
+            "source": [type(self.source).__name__, vars(self.source)],
+            "build_system": [type(self.build_system).__name__, vars(self.build_system)],
+            "compiler_flags": CONFIG.compiler_flags,
+            "compiler_preprocessor_flags": CONFIG.compiler_preprocessor_flags,
+            "linker_flags": CONFIG.linker_flags,
+            "target_arch": CONFIG.target_arch,
+            "target_os_version": CONFIG.target_os_version,
+            "deps_on": [dependencies_by_name[name].fingerprint() for name in self.deps_on],
+        }
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()
+
+    def stamp_path(self) -> Path:
+        # Stamp created once the dependency is installed, if the inputs
+        # did not change since then, there is nothing to do
+        return CONFIG.arch_dir / ".stamps" / f"{self.name}-{self.fingerprint()}"
+
+    def is_up_to_date(self) -> bool:
+        return self.stamp_path().exists()
 
     def handle(self) -> None:
+        stamp_path = self.stamp_path()
+        if stamp_path.exists():
+            LOGGER.debug(f"{self.name} is already installed and up to date")
+            return
+
         our_source_dir = CONFIG.sources_dir / self.name
         our_source_dir.mkdir(exist_ok=True)
 
@@ -321,6 +578,11 @@ class Dependency:
             LOGGER.critical(f"Failed to install {self.name}")
             maybe_log_subprocess_error(e)
 
+        stamp_path.parent.mkdir(exist_ok=True)
+        tmp_stamp_path = stamp_path.with_suffix(".tmp")
+        tmp_stamp_path.touch()
+        os.replace(tmp_stamp_path, stamp_path)
+
 
 def is_dir_empty(path: str) -> bool:
     iter = Path(path).iterdir()
@@ -333,6 +595,14 @@ def is_dir_empty(path: str) -> bool:
         return False
 
 
+class ChecksumError(Exception):
+    pass
+
+
+# Size of the chunks read when computing the checksum of an archive
+CHECKSUM_CHUNK_SIZE = 1024 * 1024
+
+
 class InternetArchive(SourceDistribution):
     def __init__(self, url: str, expected_hash: Optional[str]) -> None:
         self.url = url
@@ -348,36 +618,63 @@ class InternetArchive(SourceDistribution):
         if local_archive_path.exists():
             LOGGER.debug('Sources are already downloaded')
         else:
-            LOGGER.debug('Start downloading sources')
-            run_command([CURL, '--location', self.url, '-o', local_archive_path])
-            LOGGER.debug('Sources successfully downloaded')
+            LOGGER.debug('Start downloading and extracting sources')
+            hasher = self.new_hasher()
+            extracted_dir = download_and_extract_archive(self.url, str(local_archive_path), output_dir, hasher)
+            if hasher is not None:
+                try:
+                    self.check_digest(hasher.hexdigest(), str(local_archive_path))
+                except ChecksumError:
+                    # Do not let a corrupted archive be re-used
+                    local_archive_path.unlink()
+                    shutil.rmtree(extracted_dir)
+                    raise
+            LOGGER.debug(f"Sources successfully downloaded and extracted to {extracted_dir}")
+            return extracted_dir
 
         expected_extracted_dir = Path(output_dir) / parse_top_level_dir_of_tar(str(local_archive_path))
         if expected_extracted_dir.exists():
             LOGGER.debug("Archive already extracted")
             return str(expected_extracted_dir)
         else:
+            self.verify_checksum(str(local_archive_path))
             LOGGER.debug("Extracting sources")
             extracted_dir = extract_archive(str(local_archive_path), output_dir)
             LOGGER.debug(f"Sources extracted to {extracted_dir}")
             assert extracted_dir == str(expected_extracted_dir), f"{extracted_dir} is not the same as {expected_extracted_dir}"
             return str(extracted_dir)
 
-    def verify_checksum(self):
-        return NotImplementedError
-        # if self.expected_hash is not None:
-        #     algo, expected_hash = self.expected_hash.split(':')
-        #     if algo == 'sha256':
-        #         hashlib.sha256()
-        #     else:
-        #         raise NotImplementedError
+    def new_hasher(self):
+        """Returns the hashlib object for the algorithm of the expected hash, if any"""
+        if self.expected_hash is None:
+            return None
+        algo, _ = self.expected_hash.split(':')
+        return hashlib.new(algo)
+
+    def check_digest(self, digest: str, path: str) -> None:
+        _, expected_digest = self.expected_hash.split(':')
+        if digest != expected_digest:
+            raise ChecksumError(f"Checksum of {path} is {digest}, expected {expected_digest}")
+        LOGGER.debug(f"Checksum of {path} is valid")
+
+    def verify_checksum(self, path: str) -> None:
+        hasher = self.new_hasher()
+        if hasher is None:
+            return
+
+        with open(path, 'rb') as f:
+            while chunk := f.read(CHECKSUM_CHUNK_SIZE):
+                hasher.update(chunk)
+        self.check_digest(hasher.hexdigest(), path)
 
 
 class GitRepo(SourceDistribution):
-    def __init__(self, url: str, ref: str, after_commands: Optional[List[str]] = None):
+    def __init__(self, url: str, ref: str, after_commands: Optional[List[str]] = None, shallow: bool = True):
         self.url = url
+        # When shallow, the ref must be a branch or a tag
         self.ref = ref
         self.after_commands = after_commands if after_commands is not None else []
+        self.shallow = shallow
 
     def download_to(self, output_dir: str) -> str:
         base_name = Path(self.url).name
@@ -388,93 +685,203 @@ class GitRepo(SourceDistribution):
             return str(output_dir)
 
         LOGGER.debug('Cloning project')
-        run_command([GIT, 'clone', self.url, str(output_dir)])
+        if self.shallow:
+            # Only fetch what is needed to build the ref, not the whole history
+            run_command([GIT, 'clone', '--depth=1', '--branch', self.ref, self.url, str(output_dir)])
+        else:
+            run_command([GIT, 'clone', self.url, str(output_dir)])
 
         saved_cwd = os.getcwd()
         os.chdir(str(output_dir))
-        run_command(
-            [GIT, 'checkout', self.ref],
-        )
+        if not self.shallow:
+            run_command(
+                [GIT, 'checkout', self.ref],
+            )
 
         for command in self.after_commands:
-            run_command(command.split())
+            run_command(command.format(num_jobs=CONFIG.num_jobs).split())
         os.chdir(saved_cwd)
 
         return str(output_dir)
 
-    def verify_checksum(self):
+    def verify_checksum(self, path: str) -> None:
         pass
 
 
 class CMake(BuildSystem):
-    def __init__(self, configure_options: Dict[str, str] = None) -> None:
-        if configure_options is None:
-            self.configure_options = {**CONFIG.cmake_default_config_opts}
-        else:
-            self.configure_options = {**CONFIG.cmake_default_config_opts, **configure_options}
+    def __init__(self, configure_options: Dict[str, str] = None, unity_build: bool = False) -> None:
+        self.configure_options = {**CONFIG.cmake_default_config_opts}
+        # Merges sources into bigger translation units so that headers
+        # are parsed once per batch instead of once per file.
+        # Opt-in, many projects do not compile this way (e.g. PDAL, whose
+        # stages each define a file static `s_info`)
+        if unity_build:
+            self.configure_options["-DCMAKE_UNITY_BUILD"] = "ON"
+            self.configure_options["-DCMAKE_UNITY_BUILD_BATCH_SIZE"] = str(UNITY_BUILD_BATCH_SIZE)
+        # With Ninja Multi-Config, all the configurations are in the same build tree,
+        # so changing the configuration does not require to configure again
+        if cmake_version() >= MIN_CMAKE_MULTI_CONFIG_VERSION:
+            self.configure_options["-G"] = "Ninja Multi-Config"
+            del self.configure_options["-DCMAKE_BUILD_TYPE"]
+        if configure_options is not None:
+            self.configure_options.update(configure_options)
+        self.build_config = CONFIG.build_config
 
     def configure(self, source_dir: str, build_dir: str):
+        # CMake refuses to change the generator of an existing build tree
+        cache_path = Path(build_dir) / "CMakeCache.txt"
+        generator = self.configure_options["-G"]
+        if cache_path.exists() and f"CMAKE_GENERATOR:INTERNAL={generator}\n" not in cache_path.read_text():
+            LOGGER.debug(f"Build tree was not generated with {generator}, removing the cache")
+            cache_path.unlink()
+            shutil.rmtree(Path(build_dir) / "CMakeFiles", ignore_errors=True)
+
         options_as_cmd_args = []
         for (key, value) in self.configure_options.items():
             options_as_cmd_args.append(f"{key}={value}")
         run_command([CMAKE, '-S', source_dir, '-B', build_dir] + options_as_cmd_args)
 
     def build(self, build_dir: str):
-        run_command([CMAKE, '--build', build_dir, f'-j{CONFIG.num_jobs}'])
+        run_command([CMAKE, '--build', build_dir, '--config', self.build_config, f'-j{CONFIG.num_jobs}'])
 
     def install(self, build_dir: str):
-        run_command([CMAKE, '--install', build_dir])
+        command = [CMAKE, '--install', build_dir, '--config', self.build_config]
+        if cmake_version() >= MIN_CMAKE_PARALLEL_INSTALL_VERSION:
+            command += ['--parallel', str(CONFIG.num_jobs)]
+        run_command(command)
  
 
 class Autotools(BuildSystem):
-    def __init__(self, configure_options: List[str] = None, supports_out_of_tree_build=True) -> None:
+    def __init__(self, configure_options: List[str] = None, supports_out_of_tree_build=True, parallel_install=True) -> None:
         if configure_options is not None:
             self.configure_options = [*CONFIG.default_autotools_config_opts, *configure_options]
         else:
             self.configure_options = [*CONFIG.default_autotools_config_opts]
         self.supports_out_of_tree_build = supports_out_of_tree_build
+        # Some Makefiles have races in their install rules
+        self.parallel_install = parallel_install
+        # Autotools projects do not all support compiling for several archs at once
+        # (e.g. GMP's assembly is arch specific), for universal builds each arch
+        # is built in its own sub dir, and the installs are merged with lipo
+        self.per_arch = CONFIG.universal
+
+    def arch_build_dirs(self, build_dir: str) -> List[Tuple[Optional[str], str]]:
+        """The (arch, build dir) to build in, the arch is None when not built per arch"""
+        if not self.per_arch:
+            return [(None, build_dir)]
+        return [(arch, str(Path(build_dir) / arch)) for arch in CONFIG.target_archs]
 
     def configure(self, source_dir: str, build_dir: str):
+        for arch, arch_build_dir in self.arch_build_dirs(build_dir):
+            Path(arch_build_dir).mkdir(exist_ok=True)
+            self.configure_arch(source_dir, arch_build_dir, arch)
+
+    def configure_arch(self, source_dir: str, build_dir: str, arch: Optional[str]):
+        compiler_flags = CONFIG.compiler_flags
+        linker_flags = CONFIG.linker_flags
+        configure_options = self.configure_options
+        if arch is not None:
+            compiler_flags += f" -arch {arch}"
+            linker_flags += f" -arch {arch}"
+            if arch != HOST_MACHINE:
+                configure_options = [*configure_options, f"--host={arch}-apple-darwin"]
+
         if self.supports_out_of_tree_build:
-            with set_directory(build_dir):
-                run_command(
-                    [
-                        f"{source_dir}/configure",
-                        f"CPPFLAGS={CONFIG.compiler_preprocessor_flags}",
-                        f"CXXFLAGS={CONFIG.compiler_flags}",
-                        f"CFLAGS={CONFIG.compiler_flags}",
-                        f"LDFLAGS={CONFIG.linker_flags}",
-                    ] + self.configure_options,
-                )
+            configure_path = f"{source_dir}/configure"
         else:
             if is_dir_empty(build_dir): 
                 LOGGER.debug("Out of tree build not supported, copying sources to build dir")
                 shutil.copytree(src=source_dir, dst=build_dir, dirs_exist_ok=True)
-            with set_directory(build_dir):
-                run_command(
-                    [
-                        f"./configure",
-                        f"CPPFLAGS={CONFIG.compiler_preprocessor_flags}",
-                        f"CXXFLAGS={CONFIG.compiler_flags}",
-                        f"CFLAGS={CONFIG.compiler_flags}",
-                        f"LDFLAGS={CONFIG.linker_flags}",
-                    ] + self.configure_options,
-                )
+            configure_path = "./configure"
 
-    def build(self, build_dir: str):
         with set_directory(build_dir):
-            run_command([MAKE, f'-j{CONFIG.num_jobs}'])
+            run_command(
+                [
+                    configure_path,
+                    f"CPPFLAGS={CONFIG.compiler_preprocessor_flags}",
+                    f"CXXFLAGS={compiler_flags}",
+                    f"CFLAGS={compiler_flags}",
+                    f"LDFLAGS={linker_flags}",
+                    *CONFIG.autotools_compiler_vars,
+                ] + configure_options,
+            )
+
+    def build(self, build_dir: str):
+        for _, arch_build_dir in self.arch_build_dirs(build_dir):
+            with set_directory(arch_build_dir):
+                run_command([MAKE, f'-j{CONFIG.num_jobs}'])
 
     def install(self, build_dir: str):
+        if not self.per_arch:
+            self.make_install(build_dir)
+            return
+
+        # Each arch is installed in its own staging dir (the prefix, thus the
+        # install names, stay the same), and then merged into the install root
+        arch_install_roots = []
+        for arch, arch_build_dir in self.arch_build_dirs(build_dir):
+            destdir = Path(build_dir) / f"{arch}-destdir"
+            shutil.rmtree(destdir, ignore_errors=True)
+            self.make_install(arch_build_dir, f"DESTDIR={destdir}")
+            arch_install_roots.append(destdir / CONFIG.install_root.relative_to(CONFIG.install_root.anchor))
+        merge_arch_installs(arch_install_roots, CONFIG.install_root)
+
+    def make_install(self, build_dir: str, *make_args: str):
         with set_directory(build_dir):
-            run_command([MAKE, 'install'])
+            if self.parallel_install:
+                run_command([MAKE, f'-j{CONFIG.num_jobs}', 'install', *make_args])
+            else:
+                run_command([MAKE, 'install', *make_args])
+
+
+# First bytes of static libraries, lipo merges them like Mach-O files
+AR_MAGIC = b'!<arch>\n'
+
+
+def is_lipo_mergeable(path: Path) -> bool:
+    with open(path, 'rb') as f:
+        header = f.read(len(AR_MAGIC))
+    return header[:4] in MACHO_MAGICS or header == AR_MAGIC
+
+
+def merge_arch_installs(arch_install_roots: List[Path], install_root: Path) -> None:
+    """Merges the installs of the same dependency built for each arch into the install root
+
+    Mach-O files and static libraries are merged into universal files with lipo,
+    the other files (headers, pkg-config files, ...) are taken from the first arch.
+    """
+    first_root, *other_roots = arch_install_roots
+    for dir_path, dir_names, file_names in os.walk(first_root):
+        relative_dir = Path(dir_path).relative_to(first_root)
+        (install_root / relative_dir).mkdir(exist_ok=True, parents=True)
+        # Symlinks to dirs are listed with the dirs, but are not walked into
+        entries = [*file_names, *(name for name in dir_names if (Path(dir_path) / name).is_symlink())]
+        for name in entries:
+            src = Path(dir_path) / name
+            dst = install_root / relative_dir / name
+            if dst.is_symlink() or dst.exists():
+                dst.unlink()
+
+            if src.is_symlink():
+                dst.symlink_to(os.readlink(src))
+            elif is_lipo_mergeable(src):
+                run_command(['lipo', '-create', str(src), *(str(root / relative_dir / name) for root in other_roots),
+                             '-output', str(dst)])
+            else:
+                shutil.copy2(src, dst)
+                for root in other_roots:
+                    if not filecmp.cmp(src, root / relative_dir / name, shallow=False):
+                        LOGGER.warning(f"{relative_dir / name} differs between archs, "
+                                       f"using the one of {first_root}")
 
 
 class Qt5Build(Autotools):
     # https://wiki.qt.io/Building_Qt_5_from_Git#Getting_the_source_code
     def __init__(self):
         super().__init__()
-    
+        # qmake compiles for all the archs at once (QMAKE_APPLE_DEVICE_ARCHS)
+        self.per_arch = False
+
     def configure(self, source_dir: str, build_dir: str):
         # https://github.com/qbittorrent/qBittorrent/wiki/Compilation:-macOS-(x86_64,-arm64,-cross-compilation)
         with set_directory(build_dir):
@@ -490,18 +897,39 @@ class Qt5Build(Autotools):
                 "-qt-pcre",
                 "-qt-libjpeg",
                 "-qt-freetype",
+                # Bundled copies, so that Qt does not pick up ours depending
+                # on whether they are already installed when it is configured
+                "-qt-libpng",
+                "-qt-sqlite",
+                "-qt-tiff",
                 "-platform", "macx-clang",
                 "-prefix", str(CONFIG.install_root),
             ]
 
-            if platform.system() == "Darwin":
-                command.append(f"QMAKE_APPLE_DEVICE_ARCHS={CONFIG.target_arch}")
+            if SYSTEM == "Darwin":
+                command.append(f"QMAKE_APPLE_DEVICE_ARCHS={' '.join(CONFIG.target_archs)}")
                 command.append(f"QMAKE_MACOSX_DEPLOYMENT_TARGET={CONFIG.target_os_version}")
 
             run_command(command)
 
 
+# Compiled boost libraries needed by the dependencies (PCL, PDAL, ...),
+# headers are installed for all of boost
+DEFAULT_BOOST_LIBRARIES = [
+    "system",
+    "thread",
+    "filesystem",
+    "program_options",
+    "regex",
+    "iostreams",
+    "date_time",
+]
+
+
 class BoostBuildSystem(BuildSystem):
+    def __init__(self, libraries: Optional[List[str]] = None) -> None:
+        self.libraries = libraries if libraries is not None else DEFAULT_BOOST_LIBRARIES
+
     # Useful for cross compilation
     def configure(self, source_dir: str, build_dir: str):
         if is_dir_empty(build_dir):
@@ -509,31 +937,39 @@ class BoostBuildSystem(BuildSystem):
             shutil.copytree(src=source_dir, dst=build_dir, dirs_exist_ok=True)
 
         with set_directory(build_dir):
-            cxx_flags_value = f"-arch {CONFIG.target_arch}"
+            archs_flags = " ".join(f"-arch {arch}" for arch in CONFIG.target_archs)
+            cxx_flags_value = archs_flags
             c_flags = cxx_flags_value
-            linkflags = f"-arch {CONFIG.target_arch}"
+            linkflags = archs_flags
             run_command([
                 f'./bootstrap.sh',
                 f'cxxflags={cxx_flags_value}',
                 f'cflags={c_flags}',
                 f'linkflags={linkflags}',
-                f"--prefix={CONFIG.install_root}"
+                f"--prefix={CONFIG.install_root}",
+                f"--with-libraries={','.join(self.libraries)}",
             ])
 
     def create_b2_command(self) -> List[str]:
-        # arm64 -> arm, x86_64 -> x86
-        architecture = CONFIG.target_arch[:3]
+        if CONFIG.universal:
+            architecture = 'combined'
+        else:
+            # arm64 -> arm, x86_64 -> x86
+            architecture = CONFIG.target_arch[:3]
 
+        # b2 compiles for all the archs at once, given all the -arch flags
+        archs_flags = "".join(f" -arch {arch}" for arch in CONFIG.target_archs) if CONFIG.universal else ""
         command = [
             './b2',
-            f'cxxflags={CONFIG.compiler_flags}',
-            f'cflags={CONFIG.compiler_flags}',
-            f'linkflags={CONFIG.linker_flags}',
+            f'cxxflags={CONFIG.compiler_flags}{archs_flags}',
+            f'cflags={CONFIG.compiler_flags}{archs_flags}',
+            f'linkflags={CONFIG.linker_flags}{archs_flags}',
             'target-os=darwin',
             f'architecture={architecture}',
+            *(f'--with-{library}' for library in self.libraries),
         ]
 
-        if CONFIG.target_arch == 'x86_64' and CONFIG.target_arch != platform.machine():
+        if CONFIG.target_arch == 'x86_64' and CONFIG.target_arch != HOST_MACHINE:
             # We are cross compiling to x86_64
             command.append('abi=sysv')
             command.append('binary-format=mach-o')
@@ -561,7 +997,12 @@ DEPENDENCIES: List[Dependency] = [
             ref="v5.15.2",
             # TODO: move this to configure step of build system ?
             after_commands=[
-                "./init-repository --module-subset=default,-qtwebengine",
+                # init-repository only selects the submodules, they are then
+                # cloned in parallel (init-repository clones them one by one)
+                "./init-repository --module-subset=default,-qtwebengine --no-update",
+                # {num_jobs} is filled when the command runs, so that the
+                # number of jobs is not part of the fingerprint of Qt5
+                "git submodule update --jobs {num_jobs}",
             ]
         ),
         build_system=Qt5Build()
@@ -580,7 +1021,8 @@ DEPENDENCIES: List[Dependency] = [
             url='https://www.mpfr.org/mpfr-current/mpfr-4.1.0.tar.xz',
             expected_hash=None,
         ),
-        build_system=Autotools()
+        build_system=Autotools(),
+        deps_on=["GMP"],
     ),
     Dependency(
         name="boost",
@@ -598,7 +1040,8 @@ DEPENDENCIES: List[Dependency] = [
             url="https://github.com/CGAL/cgal/releases/download/v5.4/CGAL-5.4-library.tar.xz",
             expected_hash=None,
         ),
-        build_system=CMake()
+        build_system=CMake(),
+        deps_on=["GMP", "MPFR", "boost"],
     ),
     Dependency(
         name="libtiff",
@@ -625,6 +1068,7 @@ DEPENDENCIES: List[Dependency] = [
         build_system=Autotools(
             configure_options=['--without-curl']
         ),
+        deps_on=["sqlite", "libtiff"],
         # source=InternetArchive(
         #     # url="http://download.osgeo.org/proj/proj-8.1.0.tar.gz",
         #     url="http://download.osgeo.org/proj/proj-9.0.0.tar.gz",
@@ -645,6 +1089,7 @@ DEPENDENCIES: List[Dependency] = [
             expected_hash=None,
         ),
         build_system=Autotools(),
+        deps_on=["proj", "libtiff"],
     ),
     Dependency(
         name="png",
@@ -663,7 +1108,9 @@ DEPENDENCIES: List[Dependency] = [
         build_system=Autotools(
             configure_options=['--with-python=no'],
             supports_out_of_tree_build=False,
-        )
+        ),
+        # Xerces-C is optional (GML, NAS and ILI drivers), but picked up when installed
+        deps_on=["proj", "libtiff", "sqlite", "libgeotiff", "png", "Xerces-C"],
     ),
     Dependency(
         name="eigen",
@@ -716,7 +1163,8 @@ DEPENDENCIES: List[Dependency] = [
 
               # "-DCMAKE_MACOSX_RPATH": "OFF",
           }
-      )
+      ),
+      deps_on=["gdal", "libgeotiff", "laz-perf", "LASzip"],
     ),
     Dependency(
         name="dlib",
@@ -729,6 +1177,8 @@ DEPENDENCIES: List[Dependency] = [
                 "-DCMAKE_CXX_FLAGS": "-DDLIB_NO_GUI_SUPPORT",
             }
         ),
+        # sqlite is optional, but picked up when installed
+        deps_on=["png", "sqlite"],
     ),
     Dependency(
         name="flann",
@@ -742,6 +1192,9 @@ DEPENDENCIES: List[Dependency] = [
                 "-DBUILD_EXAMPLES": "OFF",
                 "-DBUILD_TESTS": "OFF",
                 "-DBUILD_DOC": "OFF",
+                # Otherwise the install name is the bare lib name, and the libs
+                # linking to flann have to be patched with install_name_tool
+                "-DCMAKE_INSTALL_NAME_DIR": "@rpath",
             }
         )
     ),
@@ -770,8 +1223,10 @@ DEPENDENCIES: List[Dependency] = [
                 "-DBUILD_recognition": "OFF",
                 "-DBUILD_segmentation": "OFF",
                 "-DBUILD_simulation": "OFF",
-            }
-        )
+            },
+        ),
+        # png is optional (WITH_PNG), but picked up when installed
+        deps_on=["boost", "eigen", "flann", "png"],
     ),
     # Needed for E57 plugin
     Dependency(
@@ -785,32 +1240,149 @@ DEPENDENCIES: List[Dependency] = [
 ]
 
 
+def handle_dependency(name: str, num_jobs: int) -> None:
+    """Builds the dependency with the given name, meant to be run in a worker process"""
+    logging.basicConfig(
+        level=logging.DEBUG
+    )
+    CONFIG.num_jobs = num_jobs
+    global CURRENT_LOG_PATH
+    CURRENT_LOG_PATH = CONFIG.logs_dir / f"{name}.log"
+
+    dependency = next(dependency for dependency in DEPENDENCIES if dependency.name == name)
+    LOGGER.info(f"Handling dependency named '{dependency.name}'")
+    dependency.handle()
+
+
+# Number of archives downloaded at the same time
+MAX_PARALLEL_DOWNLOADS = 8
+
+
+def prefetch_archive(dependency: Dependency) -> str:
+    our_source_dir = CONFIG.sources_dir / dependency.name
+    our_source_dir.mkdir(exist_ok=True)
+    return dependency.source.download_to(str(our_source_dir))
+
+
+def build_dependencies(dependencies: List[Dependency], max_parallel: int) -> None:
+    """Builds the dependencies, running the ones that do not depend on each other in parallel
+
+    Each dependency is built in its own process (builds change the cwd).
+    The jobs not used by the running builds are split between the dependencies
+    started at the same time, so a dependency started alone, while nothing else
+    is built, gets all the jobs. A dependency still gets its share of
+    num_jobs / max_parallel when the others use all the jobs.
+    A dependency is started as soon as all the dependencies it depends on are installed.
+
+    Archives are all downloaded (and checked) upfront in threads, while
+    the first dependencies are built, a dependency is started once its
+    archive is ready.
+
+    The main process waits on all the builds and downloads at once, from a
+    single thread, through their futures: nothing has to poll the processes.
+    """
+    min_num_jobs = max(1, CONFIG.num_jobs // max_parallel)
+
+    known_names = {dependency.name for dependency in dependencies}
+    # Dependencies not yet started, with the dependencies they still wait for
+    waiting_on: Dict[str, set] = {}
+    for dependency in dependencies:
+        unknown_names = set(dependency.deps_on) - known_names
+        assert not unknown_names, f"{dependency.name} depends on unknown dependencies {unknown_names}"
+        waiting_on[dependency.name] = set(dependency.deps_on)
+
+    executor = ProcessPoolExecutor(max_workers=max_parallel)
+    download_executor = ThreadPoolExecutor(max_workers=MAX_PARALLEL_DOWNLOADS)
+    downloads: Dict[str, Future] = {
+        dependency.name: download_executor.submit(prefetch_archive, dependency)
+        for dependency in dependencies
+        if isinstance(dependency.source, InternetArchive) and not dependency.is_up_to_date()
+    }
+    # Name and number of jobs of the dependencies being built
+    running: Dict[Future, Tuple[str, int]] = {}
+    try:
+        while waiting_on or running:
+            ready_names = [
+                name for name, deps in waiting_on.items()
+                if not deps and (name not in downloads or downloads[name].done())
+            ]
+            starting_names = ready_names[:max_parallel - len(running)]
+            free_jobs = CONFIG.num_jobs - sum(num_jobs for _, num_jobs in running.values())
+            for name in starting_names:
+                if name in downloads:
+                    try:
+                        downloads.pop(name).result()
+                    except BaseException:
+                        LOGGER.critical(f"Failed to download the sources of '{name}'")
+                        raise
+                del waiting_on[name]
+                num_jobs = max(min_num_jobs, free_jobs // len(starting_names))
+                running[executor.submit(handle_dependency, name, num_jobs)] = (name, num_jobs)
+
+            pending_downloads = [future for future in downloads.values() if not future.done()]
+            if not running and not pending_downloads:
+                raise RuntimeError(f"Dependency cycle between {list(waiting_on.keys())}")
+
+            done, _ = wait([*running, *pending_downloads], return_when=FIRST_COMPLETED)
+            for future in done:
+                if future not in running:
+                    # A download, its dependency is started on the next iteration
+                    continue
+                name, _ = running.pop(future)
+                try:
+                    future.result()
+                except BaseException:
+                    LOGGER.critical(f"Failed to build '{name}', its output is in {CONFIG.logs_dir / f'{name}.log'}")
+                    raise
+                LOGGER.info(f"Dependency named '{name}' is installed")
+                for deps in waiting_on.values():
+                    deps.discard(name)
+    except BaseException:
+        # Reported right away, instead of once all the other running builds
+        # are done (they are not waited for, nor new ones started)
+        if running:
+            LOGGER.critical(f"Not waiting for {', '.join(name for name, _ in running.values())} to finish")
+        for future in downloads.values():
+            future.cancel()
+        download_executor.shutdown(wait=False, cancel_futures=True)
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+
+    download_executor.shutdown()
+    executor.shutdown()
+
+
+def fix_install_names(libs: List[Path], changes: Dict[str, str]) -> None:
+    """Rewrites the install names of the libs so that they point to their new location
+
+    Each lib is read once, and install_name_tool is only run on the libs that
+    need it, with all their changes in a single call.
+    """
+    for lib in libs:
+        change_args = []
+        loaded_libs, _ = read_load_commands(lib)
+        for name in map(str, loaded_libs):
+            new_name = changes.get(name)
+            if new_name is not None:
+                change_args += ['-change', name, new_name]
+        if change_args:
+            run_command(['install_name_tool', *change_args, str(lib)])
+
+
 def main():
     logging.basicConfig(
         level=logging.DEBUG
     )
 
-    for dependency in DEPENDENCIES:
-        LOGGER.info(f"Handling dependency named '{dependency.name}'")
-        dependency.handle()
-
-    run_command([
-        'install_name_tool',
-        '-change',
-        '@executable_path/../lib/liblaszip.8.dylib',
-        f"{CONFIG.install_lib / 'liblaszip.8.dylib'}",
-        f"{CONFIG.install_lib / 'libpdalcpp.dylib'}",
-    ])
-
-    pcl_libs = CONFIG.install_lib.glob('libpcl_*')
-    for lib in pcl_libs:
-        run_command([
-            'install_name_tool',
-            '-change',
-            'libflann_cpp.1.9.dylib',
-            f'{CONFIG.install_lib / "libflann_cpp.1.9.dylib"}',
-            str(lib)
-        ])
+    build_dependencies(DEPENDENCIES, CONFIG.max_parallel_dependencies)
+
+    # Install names some libs reference but that are not where the libs actually are
+    install_name_changes = {
+        '@executable_path/../lib/liblaszip.8.dylib': str(CONFIG.install_lib / 'liblaszip.8.dylib'),
+        'libflann_cpp.1.9.dylib': str(CONFIG.install_lib / 'libflann_cpp.1.9.dylib'),
+    }
+    libs = [CONFIG.install_lib / 'libpdalcpp.dylib', *CONFIG.install_lib.glob('libpcl_*')]
+    fix_install_names(libs, install_name_changes)
 
 
 if __name__ == '__main__':
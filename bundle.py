@@ -0,0 +1,45 @@
+"""Reading of the information of app bundles"""
+import functools
+import plistlib
+from pathlib import Path
+from typing import Union
+from xml.etree import ElementTree
+
+
+BINARY_PLIST_MAGIC = b'bplist00'
+
+
+@functools.lru_cache(maxsize=None)
+def read_info_plist_value(app_bundle_path: Union[str, Path], key: str) -> str:
+    """Returns the (string) value of the key in the Info.plist of the bundle
+
+    XML plists are only parsed until the key is found.
+    """
+    plist_path = Path(app_bundle_path) / 'Contents' / 'Info.plist'
+    with open(plist_path, mode='rb') as fp:
+        if fp.read(len(BINARY_PLIST_MAGIC)) == BINARY_PLIST_MAGIC:
+            fp.seek(0)
+            return plistlib.load(fp)[key]
+
+        fp.seek(0)
+        # Depth of dicts, the keys of the top level dict are at depth 1
+        depth = 0
+        is_value = False
+        for event, element in ElementTree.iterparse(fp, events=('start', 'end')):
+            if event == 'start':
+                if element.tag in ('dict', 'array'):
+                    depth += 1
+                continue
+
+            if is_value:
+                return element.text
+            if element.tag in ('dict', 'array'):
+                depth -= 1
+            # The next element to end after the key is its value
+            is_value = depth == 1 and element.tag == 'key' and element.text == key
+
+    raise KeyError(f"{key} is not in {plist_path}")
+
+
+def read_short_version(app_bundle_path: Union[str, Path]) -> str:
+    return read_info_plist_value(app_bundle_path, 'CFBundleShortVersionString')
@@ -0,0 +1,27 @@
+"""Running of the helper programs (otool, codesign, ...)"""
+import functools
+import shutil
+import subprocess
+from typing import Any, List, Sequence
+
+
+@functools.lru_cache(maxsize=None)
+def find_program(name: str) -> str:
+    path = shutil.which(name)
+    if path is None:
+        raise FileNotFoundError(f"{name} not found in PATH")
+    return path
+
+
+def run(command: Sequence[Any], **kwargs) -> subprocess.CompletedProcess:
+    """Same as subprocess.run, but lets subprocess use posix_spawn instead of fork + exec
+
+    subprocess only takes the posix_spawn path when the program is given
+    with a directory and close_fds is False (among other conditions, like
+    not giving cwd). Not closing the fds is fine, the fds opened by python
+    are not inheritable.
+    """
+    program, *args = command
+    argv: List[Any] = [find_program(str(program)), *args]
+    kwargs.setdefault('close_fds', False)
+    return subprocess.run(argv, **kwargs)
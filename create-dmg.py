@@ -3,9 +3,12 @@
 import os.path
 
 import argparse
-import subprocess
-import plistlib
 import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+from bundle import read_short_version
+from commands import run
+from macho import MachOError, arch_of
 
 parser = argparse.ArgumentParser()
 parser.add_argument("folder_path")
@@ -13,27 +16,30 @@ parser.add_argument("--ignore-unnotarized", action='store_true', default=False)
 args = parser.parse_args()
 
 
-if args.ignore_unnotarized is False:
-    check_notarization_output = subprocess.run(['spctl', '-a', '-vvv', f'{args.folder_path}/CloudCompare.app'], capture_output=True, ).stderr.decode()
-    print(check_notarization_output)
-    assert 'accepted' in check_notarization_output, 'App is not notarized by our god Apple'
-    dmg_name = ""
-else:
-    dmg_name = "unotarized-"
-
+# The checks do not depend on each other, spctl (the slow one) runs
+# while the bundle info is read
+with ThreadPoolExecutor() as executor:
+    if args.ignore_unnotarized is False:
+        spctl_future = executor.submit(
+            run, ['spctl', '-a', '-vvv', f'{args.folder_path}/CloudCompare.app'], capture_output=True,
+        )
+    version_future = executor.submit(read_short_version, f"{args.folder_path}/CloudCompare.app")
+    arch_future = executor.submit(arch_of, f'{args.folder_path}/CloudCompare.app/Contents/MacOS/CloudCompare')
 
-with open(f"{args.folder_path}/CloudCompare.app/Contents/Info.plist", mode='rb') as fp:
-    plist_info = plistlib.load(fp)
-    version_string = plist_info['CFBundleShortVersionString']
+    if args.ignore_unnotarized is False:
+        check_notarization_output = spctl_future.result().stderr.decode()
+        print(check_notarization_output)
+        assert 'accepted' in check_notarization_output, 'App is not notarized by our god Apple'
+        dmg_name = ""
+    else:
+        dmg_name = "unotarized-"
 
-file_output = subprocess.run(['file', f'{args.folder_path}/CloudCompare.app/Contents/MacOs/CloudCompare'], capture_output=True).stdout.decode()
+    version_string = version_future.result()
 
-if 'x86_64' in file_output:
-    arch = 'x86_64'
-elif 'arm64' in file_output:
-    arch = 'arm64'
-else:
-    raise SystemExit(f"Could not determine arch from {file_output}")
+    try:
+        arch = arch_future.result()
+    except MachOError as e:
+        raise SystemExit(str(e))
 
 
 dmg_name += f"CloudCompare-{version_string}-{arch}.dmg"
@@ -60,4 +66,4 @@ create_cmd = [
 ]
 
 
-subprocess.run(create_cmd)
+run(create_cmd)
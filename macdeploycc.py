@@ -1,51 +1,126 @@
 #!/usr/bin/env python3
+import ctypes
+import functools
 import os.path
+import re
 import shutil
-import subprocess
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from enum import Enum
 from pathlib import Path
 from pprint import pprint
-from typing import List, Optional, Union, NamedTuple, Dict, Tuple
+from typing import FrozenSet, List, Optional, Set, Union, NamedTuple, Dict, Tuple
 import argparse
 import itertools
 import sys
 
+from commands import run
+from macho import MachOError, is_macho, read_load_commands
 
-@dataclass
+
+@dataclass(frozen=True)
 class Library:
     path: Path
-    loaded_libs: List[Path]
-    rpaths: List[Path]
+    loaded_libs: Tuple[Path, ...]
+    rpaths: Tuple[Path, ...]
 
     @classmethod
     def from_path(cls, path: Union[str, Path]) -> 'Library':
-        otool_output = subprocess.run(['otool', '-l', str(path)], capture_output=True, check=True).stdout
-        otool_output = otool_output.decode('utf-8')
+        # The same libs are reached from the executable and from many plugins,
+        # so each one is only parsed once
+        key = os.path.abspath(path)
+        try:
+            return _LIBRARY_CACHE[key]
+        except KeyError:
+            library = cls._parse(path)
+            _LIBRARY_CACHE[key] = library
+            return library
+
+    @classmethod
+    def from_paths(cls, paths: List[Path]) -> Dict[Path, 'Library']:
+        """Parses all the libs not already parsed
+
+        The libs that cannot be read directly are given to otool,
+        with a single call per batch
+        """
+        to_parse = {os.path.abspath(path): path for path in paths}
+        to_parse = {key: path for key, path in to_parse.items() if key not in _LIBRARY_CACHE}
+        for key, path in list(to_parse.items()):
+            try:
+                _LIBRARY_CACHE[key] = cls._read(path)
+            except (MachOError, OSError):
+                continue
+            del to_parse[key]
+        keys = list(to_parse.keys())
+
+        for start in range(0, len(keys), OTOOL_BATCH_SIZE):
+            batch = keys[start:start + OTOOL_BATCH_SIZE]
+            # Not checked, the libs otool failed to read are parsed alone by from_path,
+            # which reports the error
+            otool_output = run(['otool', '-l', *batch], capture_output=True).stdout
+
+            # Each lib output starts with a "<path>:" or "<path> (architecture <arch>):" line
+            batch_keys = {os.fsencode(key): key for key in batch}
+            headers = [match for match in _OTOOL_HEADER_RE.finditer(otool_output) if match.group(1) in batch_keys]
+            sections: Dict[str, List[bytes]] = defaultdict(list)
+            for header, next_header in itertools.zip_longest(headers, headers[1:]):
+                end = next_header.start() if next_header is not None else len(otool_output)
+                sections[batch_keys[header.group(1)]].append(otool_output[header.end():end])
+
+            for key, outputs in sections.items():
+                _LIBRARY_CACHE[key] = cls._from_otool_output(to_parse[key], b''.join(outputs))
 
-        lines_iter = (line.strip() for line in otool_output.splitlines())
+        return {path: cls.from_path(path) for path in paths}
 
+    @classmethod
+    def _read(cls, path: Union[str, Path]) -> 'Library':
+        loaded_libs, rpaths = read_load_commands(path)
+        return cls(path=path, loaded_libs=tuple(loaded_libs), rpaths=tuple(rpaths))
+
+    @classmethod
+    def _parse(cls, path: Union[str, Path]) -> 'Library':
+        # Reading the file directly is way faster than running otool,
+        # which is kept for what the reader does not handle
+        try:
+            return cls._read(path)
+        except (MachOError, OSError):
+            pass
+
+        otool_output = run(['otool', '-l', str(path)], capture_output=True, check=True).stdout
+        return cls._from_otool_output(path, otool_output)
+
+    @classmethod
+    def _from_otool_output(cls, path: Union[str, Path], otool_output: bytes) -> 'Library':
         loaded_libs = []
         rpaths = []
+        for match in _OTOOL_LOAD_COMMAND_RE.finditer(otool_output):
+            name = Path(os.fsdecode(match.group(2)))
+            if match.group(1) == b'LC_RPATH':
+                rpaths.append(name)
+            else:
+                loaded_libs.append(name)
 
-        for line in lines_iter:
-            if not line.startswith("Load command"):
-                continue
+        return cls(path=path, loaded_libs=tuple(loaded_libs), rpaths=tuple(rpaths))
 
-            cmd_type = next(lines_iter)
-            if cmd_type == 'cmd LC_LOAD_DYLIB':
-                _cmd_size = next(lines_iter)
-                loaded_libs.append(Path(next(lines_iter).split()[1]))
-                _time_stamp = next(lines_iter)
-                _current_version = next(lines_iter)
-                _compatibility_version = next(lines_iter)
-            elif cmd_type == 'cmd LC_RPATH':
-                _cmd_size = next(lines_iter)
-                rpaths.append(Path(next(lines_iter).split()[1]))
-            else:
-                continue
 
-        return cls(path=path, loaded_libs=loaded_libs, rpaths=rpaths)
+# Matches the dylib loading commands (LC_LOAD_DYLIB and its weak, reexport,
+# upward and lazy variants) and the LC_RPATH commands in `otool -l` outputs, e.g:
+#           cmd LC_LOAD_DYLIB
+#       cmdsize 56
+#          name @rpath/libfoo.dylib (offset 24)
+_OTOOL_LOAD_COMMAND_RE = re.compile(
+    rb'cmd (LC_LOAD_DYLIB|LC_LOAD_WEAK_DYLIB|LC_REEXPORT_DYLIB|LC_LOAD_UPWARD_DYLIB|LC_LAZY_LOAD_DYLIB|LC_RPATH)\n\s*cmdsize \d+\n\s*(?:name|path) (.+) \(offset \d+\)'
+)
+
+# Line starting the output of a lib in `otool -l` outputs
+_OTOOL_HEADER_RE = re.compile(rb'^(.+?)(?: \(architecture \S+\))?:$', re.MULTILINE)
+
+# Libraries already parsed, by absolute path
+_LIBRARY_CACHE: Dict[str, Library] = {}
+
+# Max number of libs given to a single otool call
+OTOOL_BATCH_SIZE = 256
 
 
 def is_system_lib(lib: Path) -> bool:
@@ -60,7 +135,7 @@ def is_system_lib(lib: Path) -> bool:
 
 def list_sublibs_to_relocate(
         libs: List[Path],
-        libs_in_app_rpath: List[str],
+        libs_in_app_rpath: FrozenSet[str],
 ) -> List[Path]:
     sublibs_to_relocate = []
     for lib in libs:
@@ -85,8 +160,10 @@ class RelocationAction:
 
 
 @dataclass(unsafe_hash=True, eq=True)
-class RemoveAllRpath(RelocationAction):
+class RemoveRpaths(RelocationAction):
     lib: Path
+    # Known when planning, the lib does not have to be parsed again
+    rpaths: Tuple[Path, ...]
 
 
 @dataclass(unsafe_hash=True, eq=True)
@@ -101,115 +178,244 @@ class LoadPathChange(RelocationAction):
     new: Path
 
 
+@functools.lru_cache(maxsize=None)
 def resolve_rpath(rpath: Path, executable_path: Path) -> Path:
     if rpath.parts[0] == '@executable_path':
-        rpath =  Path(str(rpath).replace('@executable_path', str(executable_path.parent))).resolve()
+        # normpath only works on the string, contrary to resolve it does not stat each component
+        rpath = Path(os.path.normpath(Path(executable_path.parent, *rpath.parts[1:])))
     return rpath
 
 
+@functools.lru_cache(maxsize=None)
+def rpath_contents(rpath: str) -> FrozenSet[str]:
+    """Names of the entries of the rpath dir, listed once"""
+    with os.scandir(rpath) as entries:
+        return frozenset(entry.name for entry in entries)
+
+
 class AppBundleInfo:
     def __init__(self, path_to_app: Union[str, Path]) -> None:
         self.lib_info = Library.from_path(path_to_app / 'Contents' / 'MacOS' / 'CloudCompare')
         self.frameworks_path = path_to_app / 'Contents' / 'Frameworks'
+        self.exec_dir = self.lib_info.path.parent
 
         index = self.lib_info.rpaths.index(Path('@executable_path/../Frameworks'))
-        self.libs_in_rpath = [lib.name for lib in resolve_rpath(self.lib_info.rpaths[index], self.lib_info.path).iterdir()]
+        self.libs_in_rpath = rpath_contents(str(resolve_rpath(self.lib_info.rpaths[index], self.lib_info.path)))
 
 class Node:
     def __init__(self, path: Path, depth: int) -> None:
         self.path = path
         self.depth = depth
-        
+
 
 def resolve_load_path(load_path, app_info: AppBundleInfo) -> Path:
     if load_path.parts[0] == '@executable_path':
-        load_path =  Path(str(load_path).replace('@executable_path', str(app_info.lib_info.path.parent))).resolve()
+        load_path = Path(os.path.normpath(Path(app_info.exec_dir, *load_path.parts[1:])))
     return load_path
 
     
 
+# Names of the libs inside each rpath dir, shared by all the relocation plans
+_LIB_NAMES_IN_RPATHS: Dict[str, FrozenSet[str]] = {}
+
+
 def create_relocation_plan(
         root_lib: Path,
-        app_info: AppBundleInfo
+        app_info: AppBundleInfo,
+        visited: Optional[Set[str]] = None,
 ) -> Tuple[
     List[CopyLib],
     List[LoadPathChange],
-    List[RemoveAllRpath],
 ]:
 
     min_depth_for_copy = 1
-    lib_names_in_rpaths = {}
-    libs_to_analyze: List[Node] = [Node(path=root_lib, depth=0)]
+    lib_names_in_rpaths = _LIB_NAMES_IN_RPATHS
+    # Libs already planned for copy, their own dependencies are already handled.
+    # Can be shared between plans, so that the executable and the plugins
+    # do not handle their common dependencies again.
+    if visited is None:
+        visited = set()
+    # Breadth first, each level is parsed at once, and thanks to `visited`
+    # each lib is only analyzed once, whatever the number of libs depending on it
+    current_level: List[Node] = [Node(path=root_lib, depth=0)]
     
     copy_actions = []
     load_path_updates = []
-    rpath_removals = []
 
-    while libs_to_analyze:
-        current_node = libs_to_analyze.pop()
-        current_lib = Library.from_path(current_node.path)
-        # print('\t',  current_lib.path, 'depdends on')
-        # pprint(current_lib.loaded_libs, indent=4)
+    while current_level:
+        Library.from_paths([node.path for node in current_level])
+        next_level: List[Node] = []
+
+        for current_node in current_level:
+            current_lib = Library.from_path(current_node.path)
 
-        for rpath in current_lib.rpaths:
-            if rpath not in lib_names_in_rpaths:
+            # print('\t',  current_lib.path, 'depdends on')
+            # pprint(current_lib.loaded_libs, indent=4)
+
+            for rpath in current_lib.rpaths:
                 rpath = resolve_rpath(rpath, app_info.lib_info.path)
-                if rpath.exists():
-                    lib_names_in_rpaths[str(rpath)] = [lib.name for lib in rpath.iterdir()]
+                if str(rpath) not in lib_names_in_rpaths:
+                    if rpath.exists():
+                        lib_names_in_rpaths[str(rpath)] = rpath_contents(str(rpath))
                     
 
-        # pprint(lib_names_in_rpaths)
+            # pprint(lib_names_in_rpaths)
 
-        sublibs_to_relocate = list_sublibs_to_relocate(current_lib.loaded_libs, app_info.libs_in_rpath)
-        # print('\t', current_lib.path, 'depdends on relocatables')
-        # pprint(sublibs_to_relocate, indent=4)
+            sublibs_to_relocate = list_sublibs_to_relocate(current_lib.loaded_libs, app_info.libs_in_rpath)
+            # print('\t', current_lib.path, 'depdends on relocatables')
+            # pprint(sublibs_to_relocate, indent=4)
         
-        for sublib in sublibs_to_relocate:
-            if sublib.parts[0] == '@rpath':
-                for rpath, libs_inside in lib_names_in_rpaths.items():
-                    assert len(sublib.parts) == 2
-                    if sublib.parts[1] in libs_inside:
-                        # Here we don't use the `Path.resolve` method as it follow 
-                        # potential symlinks, creating an incoherence between the 
-                        # sublib load path and the path we want to copy.
-                        # symlinks are handled when actually copying
-                        resolved_path = Path(str(sublib).replace('@rpath', rpath))
-                        break
+            for sublib in sublibs_to_relocate:
+                if sublib.parts[0] == '@rpath':
+                    for rpath, libs_inside in lib_names_in_rpaths.items():
+                        assert len(sublib.parts) == 2
+                        if sublib.parts[1] in libs_inside:
+                            # Here we don't use the `Path.resolve` method as it follow 
+                            # potential symlinks, creating an incoherence between the 
+                            # sublib load path and the path we want to copy.
+                            # symlinks are handled when actually copying
+                            resolved_path = Path(str(sublib).replace('@rpath', rpath))
+                            break
+                    else:
+                        raise RuntimeError(f"Failed to find {sublib} in any rpath")
                 else:
-                    raise RuntimeError(f"Failed to find {sublib} in any rpath")
-            else:
-                resolved_path = resolve_load_path(sublib, app_info)
+                    resolved_path = resolve_load_path(sublib, app_info)
+
+                # If resolbed path does not exists, we won't be able to copy it
+                assert resolved_path.exists(), f"{resolved_path} does not exists"
+                # print(str(sublib), "resolved to", str(resolved_path))
+
+                # Cycles between copied libs are already cut by `visited`, which stops both
+                # the copy and the descent, only a lib loading the root would loop
+                # (and copy the root itself into the Frameworks dir)
+                if resolved_path == root_lib:
+                    print(f"Warning: dependency cycle, {current_node.path} depends on {root_lib}"
+                          f" which (indirectly) loads it, skipping that dependency", file=sys.stderr)
+                    continue
+
+                subnode = Node(resolved_path, depth=current_node.depth + 1)
+                if subnode.depth >= min_depth_for_copy:
+                    # since we will be copying the sublib, to the frameworks_path,
+                    # we need to update the load path of dependent lib
+                    # which here, is the current_node, which, may get copied
+                    update_load_path = LoadPathChange(
+                        lib=Path(app_info.frameworks_path) / current_node.path.name if current_node.depth >= min_depth_for_copy else current_node.path,
+                        old=sublib,
+                        new=f"@rpath/{sublib.name}",
+                    )
+                    load_path_updates.append(update_load_path)
 
-            # If resolbed path does not exists, we won't be able to copy it
-            assert resolved_path.exists(), f"{resolved_path} does not exists"
-            # print(str(sublib), "resolved to", str(resolved_path))
+                    if str(resolved_path) in visited:
+                        continue
+                    visited.add(str(resolved_path))
 
-            subnode = Node(resolved_path, depth=current_node.depth + 1)
-            if subnode.depth >= min_depth_for_copy:
-                copy_action = CopyLib(
-                        src=resolved_path,
-                        dst=Path(app_info.frameworks_path) / resolved_path.name,
-                    )
-                # since we will be copying the sublib, to the frameworks_path,
-                # we need to update the load path of dependent lib
-                # which here, is the current_node, which, may get copied
-                update_load_path = LoadPathChange(
-                    lib=Path(app_info.frameworks_path) / current_node.path.name if current_node.depth >= min_depth_for_copy else current_node.path,
-                    old=sublib,
-                    new=f"@rpath/{sublib.name}",
-                )
+                    copy_action = CopyLib(
+                            src=resolved_path,
+                            dst=Path(app_info.frameworks_path) / resolved_path.name,
+                        )
+                    copy_actions.append(copy_action)
+
+                    next_level.append(subnode)
+
+        current_level = next_level
+
+    return copy_actions, load_path_updates
+
+
+
+def list_code_to_sign(app_bundle_path: Path) -> List[Path]:
+    """Lists the frameworks and the Mach-O files of the bundle that have to be signed
+    before the bundle itself
+    """
+    to_sign = []
+    frameworks_path = app_bundle_path / 'Contents' / 'Frameworks'
+    if frameworks_path.is_dir():
+        for entry in frameworks_path.iterdir():
+            if entry.suffix == '.framework':
+                # Signed as a whole, this signs its binary
+                to_sign.append(entry)
+            elif entry.is_file() and not entry.is_symlink() and is_macho(entry):
+                to_sign.append(entry)
+
+    plugins_path = app_bundle_path / 'Contents' / 'Plugins'
+    if plugins_path.is_dir():
+        for dirpath, _dirnames, filenames in os.walk(plugins_path):
+            for filename in filenames:
+                path = Path(dirpath) / filename
+                if not path.is_symlink() and is_macho(path):
+                    to_sign.append(path)
+
+    return to_sign
+
+
+def sign_bundle(app_bundle_path: Path, signing_id: str) -> None:
+    """Signs the bundle from the inside out, without the deprecated --deep
 
-                remove_rpath_action = RemoveAllRpath(copy_action.dst)
+    Nested code must be signed before what contains it, so the code is signed
+    from the deepest to the shallowest, with one codesign call for all
+    the paths at the same depth, and the bundle itself last.
+    """
+    codesign_command = ['codesign', '--verify', '--force', '--options=runtime', '--timestamp',
+                        '--sign', signing_id]
 
-                copy_actions.append(copy_action)
-                load_path_updates.append(update_load_path)
-                rpath_removals.append(remove_rpath_action)
+    paths_by_depth: Dict[int, List[Path]] = defaultdict(list)
+    for path in list_code_to_sign(app_bundle_path):
+        paths_by_depth[len(path.relative_to(app_bundle_path).parts)].append(path)
 
-                libs_to_analyze.append(subnode)
+    for depth in sorted(paths_by_depth.keys(), reverse=True):
+        run([*codesign_command, *paths_by_depth[depth]], check=True)
 
+    run([*codesign_command, app_bundle_path], capture_output=False)
 
-    return copy_actions, load_path_updates, rpath_removals
 
+def _load_copyfile():
+    """Returns the copyfile(3) function of the libc, if there is one (macOS)"""
+    if sys.platform != 'darwin':
+        return None
+    libc = ctypes.CDLL(None, use_errno=True)
+    try:
+        copyfile = libc.copyfile
+    except AttributeError:
+        return None
+    copyfile.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_void_p, ctypes.c_uint32]
+    copyfile.restype = ctypes.c_int
+    return copyfile
+
+
+_COPYFILE = _load_copyfile()
+
+# See <copyfile.h>, clones when possible, otherwise the data and metadata
+# are copied by the kernel, no need to handle the fallback ourselves
+COPYFILE_ALL = 0xf
+COPYFILE_CLONE = 1 << 24
+
+
+def copy_file(src: Path, dst: Path) -> None:
+    """Copies the file, as a copy on write clone when possible
+
+    On APFS a clone is done in constant time, whatever the size of the file,
+    otherwise (other volume, other file system) the bytes are copied.
+    """
+    if _COPYFILE is None:
+        shutil.copy2(src=src, dst=dst)
+        return
+
+    # COPYFILE_CLONE does not follow symlinks and does not overwrite,
+    # copy2 did both
+    src = os.path.realpath(src)
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    if _COPYFILE(os.fsencode(src), os.fsencode(dst), None, COPYFILE_ALL | COPYFILE_CLONE) != 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error), str(src))
+
+
+# Number of libs copied at the same time into the bundle
+MAX_PARALLEL_COPIES = 8
+
+
+# Number of install_name_tool run at the same time
+MAX_PARALLEL_INSTALL_NAME_TOOL = 8
 
 
 def main():
@@ -225,67 +431,90 @@ def main():
     executable_path = app_bundle_path / 'Contents' / 'MacOS' / 'CloudCompare'
     plugins_folder_path = app_bundle_path / 'Contents' / 'Plugins' / 'ccPlugins'
 
+    # The executable and plugins are parsed in one go
+    Library.from_paths([executable_path, *plugins_folder_path.iterdir()])
     info = AppBundleInfo(app_bundle_path)
 
     all_copy_actions = []
     all_update_actions = []
-    all_rpath_removals = []
 
-    copy_actions, update_actions, rpah_actions = create_relocation_plan(executable_path, app_info=info)
+    # Shared so that the dependencies common to the executable and plugins are handled once
+    visited: Set[str] = set()
+    copy_actions, update_actions = create_relocation_plan(executable_path, app_info=info, visited=visited)
     all_copy_actions.extend(copy_actions)
     all_update_actions.extend(update_actions)
-    all_rpath_removals.extend(rpah_actions)
 
     for plugin in plugins_folder_path.iterdir():
         # if not str(plugin.name).startswith('libQPDAL'):
         #     continue
         print()
         print(plugin.name)
-        copy_actions, update_actions, rpah_actions = create_relocation_plan(plugin, app_info=info)
+        copy_actions, update_actions = create_relocation_plan(plugin, app_info=info, visited=visited)
         print("copy actions")
         pprint(copy_actions)
         print("update_load_path")
         pprint(update_actions)
         all_copy_actions.extend(copy_actions)
         all_update_actions.extend(update_actions)
-    all_rpath_removals.extend(rpah_actions)
 
+    # Each destination is written once (which also avoids concurrent writes to it),
+    # from the first source planned for it
+    copies_to_do = []
+    # Libs already in the Frameworks folder, they are relocated in place
+    libs_in_place = []
+    src_by_dst: Dict[Path, Path] = {}
     for action in all_copy_actions:
         if action.src == action.dst:
             assert str(action.src).startswith(str(info.frameworks_path))
+            libs_in_place.append(action)
+            continue
+        previous_src = src_by_dst.get(action.dst)
+        if previous_src is not None:
+            # Different paths (e.g. symlinks) to the same file are fine
+            if not os.path.samefile(previous_src, action.src):
+                print(f"Warning: {previous_src} and {action.src} are both copied to {action.dst},"
+                      f" keeping {previous_src}", file=sys.stderr)
             continue
-        shutil.copy2(src=action.src, dst=action.dst)
+        src_by_dst[action.dst] = action.src
+        copies_to_do.append(action)
+
+    # Copies are IO bound, threads can do them in parallel
+    with ThreadPoolExecutor(max_workers=MAX_PARALLEL_COPIES) as executor:
+        list(executor.map(lambda action: copy_file(src=action.src, dst=action.dst), copies_to_do))
 
+    # install_name_tool is run once per lib, with all the changes
+    # and rpath removals to do in it
+    args_by_lib: Dict[Path, List[str]] = defaultdict(list)
+    changes_by_lib: Dict[Path, Dict[str, str]] = defaultdict(dict)
     for action in all_update_actions:
-        subprocess.run([
-            'install_name_tool',
-            '-change',
-            str(action.old),
-            str(action.new),
-            str(action.lib),
-        ])
-
-    for action in all_rpath_removals:
-        lib = Library.from_path(action.lib)
-        for rpath in lib.rpaths:
-            subprocess.run([
-                'install_name_tool',
-                '-delete_rpath',
-                str(rpath),
-                str(action.lib),
-            ],
-                check=True
-            )
+        changes_by_lib[action.lib][str(action.old)] = str(action.new)
+    for lib, changes in changes_by_lib.items():
+        args_by_lib[lib].extend(itertools.chain.from_iterable(('-change', old, new) for old, new in changes.items()))
+
+    # The rpaths removed are the ones of the file actually written to each
+    # destination, not of every source planned for it, and each once
+    rpath_removals: Dict[Path, RemoveRpaths] = {
+        action.dst: RemoveRpaths(action.dst, Library.from_path(action.src).rpaths)
+        for action in [*libs_in_place, *copies_to_do]
+    }
+    for action in rpath_removals.values():
+        args_by_lib[action.lib].extend(itertools.chain.from_iterable(('-delete_rpath', str(rpath)) for rpath in action.rpaths))
+
+    # Each call rewrites a different lib, they can run at the same time
+    with ThreadPoolExecutor(max_workers=MAX_PARALLEL_INSTALL_NAME_TOOL) as executor:
+        list(executor.map(
+            lambda lib_args: run(['install_name_tool', *lib_args[1], str(lib_args[0])], check=True),
+            [(lib, args) for lib, args in args_by_lib.items() if args],
+        ))
 
 
     if True:
         print()
         signing_id = input('Signing ID: ')
-        subprocess.run(['codesign', '--verify', '--force', '--options=runtime', '--timestamp', '--deep',
-                        '--sign', signing_id, app_bundle_path], capture_output=False)
+        sign_bundle(app_bundle_path, signing_id)
 
         print()
-        subprocess.run(['codesign', '-vvv', '--deep', app_bundle_path])
+        run(['codesign', '-vvv', '--deep', app_bundle_path])
 
 
 
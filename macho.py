@@ -0,0 +1,145 @@
+"""Minimal reading of Mach-O files, without running otool / file"""
+import struct
+from pathlib import Path
+from typing import List, Tuple, Union
+
+
+# First bytes of Mach-O files (thin 32/64 bits in both endianness, and fat 32/64 bits)
+MACHO_MAGICS = {
+    b'\xfe\xed\xfa\xce', b'\xce\xfa\xed\xfe',
+    b'\xfe\xed\xfa\xcf', b'\xcf\xfa\xed\xfe',
+    b'\xca\xfe\xba\xbe', b'\xca\xfe\xba\xbf',
+}
+
+# See <mach-o/loader.h> and <mach-o/fat.h>
+MH_MAGIC = 0xfeedface
+MH_MAGIC_64 = 0xfeedfacf
+FAT_MAGIC = 0xcafebabe
+FAT_MAGIC_64 = 0xcafebabf
+LC_LOAD_DYLIB = 0xc
+LC_LAZY_LOAD_DYLIB = 0x20
+LC_LOAD_WEAK_DYLIB = 0x80000018
+LC_REEXPORT_DYLIB = 0x8000001f
+LC_LOAD_UPWARD_DYLIB = 0x80000023
+LC_RPATH = 0x8000001c
+
+# All the commands that make the file load a dylib, they all have to be relocated
+LC_DYLIB_COMMANDS = {
+    LC_LOAD_DYLIB,
+    LC_LAZY_LOAD_DYLIB,
+    LC_LOAD_WEAK_DYLIB,
+    LC_REEXPORT_DYLIB,
+    LC_LOAD_UPWARD_DYLIB,
+}
+
+
+class MachOError(Exception):
+    pass
+
+
+def is_macho(path: Path) -> bool:
+    with open(path, 'rb') as f:
+        return f.read(4) in MACHO_MAGICS
+
+
+def read_load_commands(path: Union[str, Path]) -> Tuple[List[Path], List[Path]]:
+    """Reads the libs loaded (LC_LOAD_DYLIB and variants) and the rpaths (LC_RPATH) of a Mach-O file
+
+    Only the headers and load commands are read, not the whole file.
+    For fat files, the first arch is read, all the archs of our builds
+    have the same load commands.
+    """
+    try:
+        return _read_load_commands(path)
+    except (struct.error, UnicodeDecodeError) as e:
+        raise MachOError(f"{path} is not a valid Mach-O file: {e}") from e
+
+
+def _read_load_commands(path: Union[str, Path]) -> Tuple[List[Path], List[Path]]:
+    with open(path, 'rb') as f:
+        offset = 0
+        header = f.read(8)
+        if len(header) < 8:
+            raise MachOError(f"{path} is not a Mach-O file")
+
+        magic, = struct.unpack('>I', header[:4])
+        if magic in (FAT_MAGIC, FAT_MAGIC_64):
+            if magic == FAT_MAGIC:
+                _cputype, _cpusubtype, offset = struct.unpack('>iiI', f.read(12))
+            else:
+                _cputype, _cpusubtype, offset = struct.unpack('>iiQ', f.read(16))
+            f.seek(offset)
+            header = f.read(8)
+
+        for endianness in ('<', '>'):
+            magic, = struct.unpack(f'{endianness}I', header[:4])
+            if magic in (MH_MAGIC, MH_MAGIC_64):
+                break
+        else:
+            raise MachOError(f"{path} is not a Mach-O file")
+
+        header_size = 32 if magic == MH_MAGIC_64 else 28
+        f.seek(offset + 16)
+        num_commands, size_of_commands = struct.unpack(f'{endianness}II', f.read(8))
+        f.seek(offset + header_size)
+        commands = f.read(size_of_commands)
+
+    loaded_libs = []
+    rpaths = []
+    position = 0
+    for _ in range(num_commands):
+        cmd, cmd_size, str_offset = struct.unpack_from(f'{endianness}III', commands, position)
+        if cmd in LC_DYLIB_COMMANDS or cmd == LC_RPATH:
+            raw = commands[position + str_offset:position + cmd_size]
+            name = Path(raw.split(b'\0', 1)[0].decode('utf-8'))
+            if cmd in LC_DYLIB_COMMANDS:
+                loaded_libs.append(name)
+            else:
+                rpaths.append(name)
+        position += cmd_size
+
+    return loaded_libs, rpaths
+
+
+# See <mach/machine.h>
+CPU_TYPE_NAMES = {
+    0x01000007: 'x86_64',
+    0x0100000c: 'arm64',
+}
+
+# Name of the arch of fat files that have more than one
+UNIVERSAL_ARCH = 'universal'
+
+
+def arch_of(path: Union[str, Path]) -> str:
+    """Returns the arch of a Mach-O file ('x86_64', 'arm64')
+    or 'universal' for fat files with several archs
+    """
+    with open(path, 'rb') as f:
+        header = f.read(8)
+        if len(header) < 8:
+            raise MachOError(f"{path} is not a Mach-O file")
+
+        magic, num_archs = struct.unpack('>II', header)
+        if magic in (FAT_MAGIC, FAT_MAGIC_64):
+            fat_arch_size = 20 if magic == FAT_MAGIC else 32
+            fat_archs = f.read(fat_arch_size * num_archs)
+            cpu_types = [
+                struct.unpack_from('>i', fat_archs, index * fat_arch_size)[0]
+                for index in range(num_archs)
+            ]
+            if len(cpu_types) > 1:
+                return UNIVERSAL_ARCH
+        else:
+            for endianness in ('<', '>'):
+                magic, cpu_type = struct.unpack(f'{endianness}Ii', header)
+                if magic in (MH_MAGIC, MH_MAGIC_64):
+                    break
+            else:
+                raise MachOError(f"{path} is not a Mach-O file")
+            cpu_types = [cpu_type]
+
+    try:
+        return CPU_TYPE_NAMES[cpu_types[0]]
+    except (KeyError, IndexError):
+        raise MachOError(f"Could not determine the arch of {path}")
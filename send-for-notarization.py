@@ -1,60 +1,76 @@
 #!/usr/bin/env python3
 
 from argparse import ArgumentParser
-import subprocess
-import plistlib
+import os.path
+
+from bundle import read_short_version
+from commands import run
+from macho import MachOError, arch_of
 
 
 
 def main():
 	parser = ArgumentParser()
 	parser.add_argument("app_bundle_path")
+	parser.add_argument("--keychain-profile", help="Profile of the credentials stored with "
+	                                               "'xcrun notarytool store-credentials', nothing is asked when given")
+	parser.add_argument("--apple-id", help="AppleID email, asked when not given (without --keychain-profile)")
+	parser.add_argument("--team-id", help="Developer Team ID, asked when not given (without --keychain-profile)")
 	args = parser.parse_args()
 
 	assert args.app_bundle_path.endswith(".app"), "Must point to a .app"
 
 
-	with open(f"{args.app_bundle_path}/Contents/Info.plist", mode='rb') as fp:
-	    plist_info = plistlib.load(fp)
-	    version_string = plist_info['CFBundleShortVersionString']
+	version_string = read_short_version(args.app_bundle_path)
 
-	file_output = subprocess.run(['file', f'{args.app_bundle_path}/Contents/MacOs/CloudCompare'], capture_output=True).stdout.decode()
+	try:
+	    arch = arch_of(f'{args.app_bundle_path}/Contents/MacOS/CloudCompare')
+	except MachOError as e:
+	    raise SystemExit(str(e))
 
-	if 'x86_64' in file_output:
-	    arch = 'x86_64'
-	elif 'arm64' in file_output:
-	    arch = 'arm64'
-	else:
-	    raise SystemExit(f"Could not determine arch from {file_output}")
-
-
-	zip_path = f"./workdir/{arch}/CloudCompare-{version_string}-{arch}.zip"
-	subprocess.run([
-		'ditto',
-		'-c',
-		'-k',
-		'-rsrc',
-		'--sequesterRsrc',
-		'--keepParent',
-		args.app_bundle_path,
-		zip_path
-	], 
+
+	# Absolute, zip runs from the dir of the bundle
+	zip_path = os.path.abspath(f"./workdir/{arch}/CloudCompare-{version_string}-{arch}.zip")
+	# zip would add to an existing archive
+	if os.path.exists(zip_path):
+		os.remove(zip_path)
+
+	# The archive is only read by the notary service, so the fastest compression
+	# is used (ditto is single threaded with a high compression level).
+	# -y stores the symlinks of the frameworks as symlinks
+	app_bundle_path = os.path.abspath(args.app_bundle_path.rstrip('/'))
+	run([
+		'zip',
+		'-r',
+		'-1',
+		'-y',
+		'-q',
+		zip_path,
+		os.path.basename(app_bundle_path),
+	],
+		cwd=os.path.dirname(app_bundle_path),
 		check=True
 	)
 
-	apple_email_id = input("Enter AppleID email: ")
+	if args.keychain_profile is not None:
+		credentials = ['--keychain-profile', args.keychain_profile]
+	else:
+		apple_email_id = args.apple_id or input("Enter AppleID email: ")
+		team_id = args.team_id or input("Enter Team ID: ")
+		# notarytool asks for the app-specific password
+		credentials = ['--apple-id', apple_email_id, '--team-id', team_id]
 
-	subprocess.run([
+	# --wait returns once the notarization is done, no need to poll its status
+	run([
 		'xcrun',
-		'altool',
-		'--notarize-app',
-		'--primary-bundle-id',
-		'org.cloudcompare.cloudcompare',
-		'-u',
-		apple_email_id,
-		'--file',
-		zip_path
-	])
+		'notarytool',
+		'submit',
+		zip_path,
+		*credentials,
+		'--wait',
+	],
+		check=True
+	)
 
 	
 